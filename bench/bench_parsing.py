@@ -0,0 +1,77 @@
+"""Микробенчмарк разбора списка продуктов (src/export/parsing.py).
+
+Запуск из корня проекта: python -m bench.bench_parsing --subjects 2000 --products 1 50
+Сначала разбор сверяется с прежним на сгенерированных описаниях; при расхождении скрипт завершается с ошибкой.
+Эталонные примеры описаний — в tests/test_parsing.py.
+"""
+import argparse
+import html
+import sys
+import time
+from typing import Callable, List, Sequence
+
+from bench.fake_megaplan import FakeMegaplanData
+from src.export.parsing import ProductParser
+
+
+def legacy_parse(subject: str) -> List[str]:
+    """Прежний разбор (unescape + цепочка replace + split), для сравнения скорости."""
+    text = html.unescape(subject)
+    text = text.replace('<br />', '\n').replace('</p>', '\n').replace('<p>', '').replace('</strong>', '').replace(
+        '<strong>', '').strip()
+    products = text.split("\n\n")
+    if len(products) == 1:
+        if all(el[0].isdigit() for el in text.split("\n") if el):
+            products = text.split("\n")
+    return [product for product in products if any(char.isdigit() for char in product)]
+
+
+def check_generated(subjects: Sequence[str]) -> int:
+    """На описаниях из фейкового Megaplan новый разбор должен совпадать с прежним."""
+    parser = ProductParser(maxsize=0)
+    failures = 0
+    for subject in subjects:
+        if list(parser.parse(subject)) != legacy_parse(subject):
+            failures += 1
+            if failures <= 3:
+                print(f"FAIL generated {subject[:120]!r}")
+    return failures
+
+
+def measure(name: str, function: Callable[[str], object], subjects: Sequence[str], rounds: int) -> float:
+    best = float("inf")
+    for _ in range(rounds):
+        started = time.perf_counter()
+        for subject in subjects:
+            function(subject)
+        best = min(best, time.perf_counter() - started)
+    per_subject_us = best / len(subjects) * 1e6
+    print(f"{name:>24} {best * 1000:>10.1f} мс {per_subject_us:>10.1f} мкс/описание")
+    return best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Product parsing micro-benchmark")
+    parser.add_argument("--subjects", type=int, default=2000, help="число сгенерированных описаний")
+    parser.add_argument("--products", type=int, nargs=2, default=[1, 50], metavar=("MIN", "MAX"))
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    data = FakeMegaplanData()
+    subjects = [data._subject(data.random.randint(*args.products)) for _ in range(args.subjects)]
+    failures = check_generated(subjects)
+    if failures:
+        print(f"Разбор расходится с прежним: {failures}")
+        sys.exit(1)
+    print(f"Разбор совпадает с прежним на {len(subjects)} сгенерированных описаниях")
+
+    measure("прежний разбор", legacy_parse, subjects, args.rounds)
+    measure("новый разбор, без кэша", ProductParser(maxsize=0).parse, subjects, args.rounds)
+    cached = ProductParser(maxsize=len(subjects))
+    for subject in subjects:
+        cached.parse(subject)
+    measure("новый разбор, из кэша", cached.parse, subjects, args.rounds)
+
+
+if __name__ == "__main__":
+    main()
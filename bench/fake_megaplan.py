@@ -0,0 +1,258 @@
+"""Локальная имитация Megaplan API v3 для бенчмарков и нагрузочных тестов.
+
+Запуск отдельно: python -m bench.fake_megaplan --port 8081 --issues 100 --latency 0.05
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import unquote
+
+PRODUCT_WORDS = ["Крем", "Шампунь", "Бальзам", "Маска", "Сыворотка", "Гель", "Тоник", "Скраб"]
+FEATURES = ["увлажняющий", "питательный", "для сухих волос", "SPF 30", "с гиалуроновой кислотой", "ночной"]
+STATUSES = ["Согласовано", "В работе", "Ожидаем образцы", "Нет поставщика", "Запрошены КП"]
+
+
+class FakeMegaplanData:
+    """Синтетические проекты с иерархией задач как в реальной выгрузке."""
+
+    def __init__(self, seed: int = 42):
+        self.random = random.Random(seed)
+        self.projects: Dict[str, Dict] = {}
+        self.project_issues: Dict[str, List[str]] = {}
+        self.tasks: Dict[str, Dict] = {}
+        self.comments: Dict[str, Dict] = {}
+        self.employees: Dict[str, Dict] = {}
+        self.expected_rows: Dict[str, int] = {}
+        self._next_id = 1000
+        for _ in range(20):
+            employee_id = self._new_id()
+            self.employees[employee_id] = {"id": employee_id, "contentType": "Employee",
+                                           "name": f"Сотрудник {employee_id}"}
+
+    def _new_id(self) -> str:
+        self._next_id += 1
+        return str(self._next_id)
+
+    def _responsible(self) -> Dict:
+        employee = self.employees[self.random.choice(list(self.employees))]
+        # Как и в Megaplan, имя во вложенной сущности приходит не всегда
+        if self.random.random() < 0.5:
+            return {"id": employee["id"], "contentType": "Employee", "name": employee["name"]}
+        return {"id": employee["id"], "contentType": "Employee"}
+
+    def _time(self, days_ago: int = 0) -> Dict:
+        value = datetime(2024, 5, 1, 10, 0, tzinfo=timezone(timedelta(hours=3))) - timedelta(days=days_ago)
+        return {"contentType": "DateTime", "value": value.strftime("%Y-%m-%dT%H:%M:%S%z")}
+
+    def _task(self, name: str, **fields) -> Dict:
+        task_id = self._new_id()
+        task = {"id": task_id, "contentType": "Task", "name": name, "subTasks": [], "lastComment": None,
+                "responsible": self._responsible(), "subject": "", "actualStart": self._time(),
+                "timeUpdated": self._time(), "description": "Описание задачи. " * 20}
+        task.update(fields)
+        self.tasks[task_id] = task
+        return task
+
+    @staticmethod
+    def _compact(entity: Dict) -> Dict:
+        return {"id": entity["id"], "contentType": entity["contentType"], "name": entity["name"]}
+
+    def _subject(self, products: int) -> str:
+        names = [f"{number}. {self.random.choice(PRODUCT_WORDS)} {self.random.choice(FEATURES)} "
+                 f"{self.random.choice([50, 100, 200, 250])} мл" for number in range(1, products + 1)]
+        if self.random.random() < 0.5:
+            return "".join(f"<p>{name}</p>" for name in names)
+        # Продукты из нескольких строк разделяются пустой строкой
+        return "<p><strong>Продукты:</strong></p><br />" + "".join(f"<p>{name}<br />арт. {index}</p><br />"
+                                                                  for index, name in enumerate(names, 1))
+
+    def add_project(self, project_id: str, issues: int, min_products: int = 1, max_products: int = 50) -> None:
+        self.projects[project_id] = {"id": project_id, "contentType": "Project", "name": f"Бренд {project_id}",
+                                     "responsible": self._responsible()}
+        self.project_issues[project_id] = []
+        rows = 0
+        for number in range(1, issues + 1):
+            products = self.random.randint(min_products, max_products)
+            rows += products
+            raw_materials = self._task("1. Поставщики сырья",
+                                       Category130CustomFieldStatus=self.random.choice(STATUSES))
+            packaging = self._task("2. Поставщики упаковки",
+                                   Category130CustomFieldStatus=self.random.choice(STATUSES))
+            development = self._task(f"Разработка продуктов {number}", subject=self._subject(products),
+                                     subTasks=[self._compact(raw_materials), self._compact(packaging)])
+            if self.random.random() < 0.8:
+                comment_id = self._new_id()
+                self.comments[comment_id] = {"id": comment_id, "contentType": "Comment",
+                                             "content": f"<p>Комментарий по линейке {number}</p>"}
+                development["lastComment"] = {"id": comment_id, "contentType": "Comment"}
+            issue = self._task(f"{number}. Линейка {number}", subTasks=[self._compact(development)],
+                               actualStart=self._time(number % 60))
+            self.project_issues[project_id].append(issue["id"])
+        self.expected_rows[project_id] = rows
+
+    def touch(self, task_id: str) -> None:
+        """Помечает задачу изменённой (для проверки инкрементальной выгрузки)."""
+        self.tasks[task_id]["timeUpdated"] = {"contentType": "DateTime",
+                                              "value": datetime.now(timezone.utc).isoformat()}
+
+
+def _project_fields(entity: Dict, fields: Optional[List]) -> Dict:
+    if not fields:
+        return entity
+    projected = {"id": entity["id"], "contentType": entity["contentType"]}
+    for name in fields:
+        if isinstance(name, str) and name in entity:
+            projected[name] = entity[name]
+    return projected
+
+
+class FakeMegaplanServer:
+    """HTTP-сервер с настраиваемой задержкой ответа и лимитом запросов в секунду."""
+
+    def __init__(self, data: FakeMegaplanData, host: str = "127.0.0.1", port: int = 0,
+                 latency: float = 0.0, rate_limit: float = 0.0):
+        self.data = data
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.calls: Counter = Counter()
+        self.bytes_sent = 0
+        self.uploads: List[Tuple[str, int]] = []
+        self.posted_comments: List[Dict] = []
+        self._lock = threading.Lock()
+        self._window_start = time.monotonic()
+        self._window_calls = 0
+        self.httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self.httpd.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "FakeMegaplanServer":
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def reset_stats(self) -> None:
+        with self._lock:
+            self.calls.clear()
+            self.bytes_sent = 0
+
+    def _throttled(self) -> bool:
+        if not self.rate_limit:
+            return False
+        with self._lock:
+            now = time.monotonic()
+            if now - self._window_start >= 1:
+                self._window_start, self._window_calls = now, 0
+            self._window_calls += 1
+            return self._window_calls > self.rate_limit
+
+    def _route(self, method: str, path: str, body: bytes) -> Tuple[str, int, Optional[Dict]]:
+        data = self.data
+        path, _, query = path.partition("?")
+        fields = json.loads(unquote(query)).get("fields") if query else None
+        parts = path.strip("/").split("/")
+        if method == "POST" and path == "/api/file":
+            match = re.search(rb'filename="([^"]*)"', body)
+            name = match.group(1).decode("utf-8") if match else ""
+            self.uploads.append((name, len(body)))
+            return "upload_file", 200, {"data": [{"id": f"file-{len(self.uploads)}", "contentType": "File"}]}
+        if parts[:2] != ["api", "v3"] or len(parts) < 4:
+            return "unknown", 404, None
+        kind, entity_id, rest = parts[2], parts[3], parts[4:]
+        if method == "POST" and rest == ["comments"]:
+            self.posted_comments.append(json.loads(body))
+            return "post_comment", 200, {"data": {"id": self.data._new_id(), "contentType": "Comment"}}
+        if kind == "project" and entity_id in data.projects:
+            if rest == ["issues"]:
+                issues = [_project_fields(data.tasks[task_id], fields) for task_id in data.project_issues[entity_id]]
+                return "get_project_issues", 200, {"data": issues}
+            return "get_project", 200, {"data": _project_fields(data.projects[entity_id], fields)}
+        if kind == "task" and entity_id in data.tasks:
+            task = data.tasks[entity_id]
+            if rest == ["subTasks"]:
+                subtasks = [_project_fields(data.tasks[sub["id"]], fields) for sub in task["subTasks"]]
+                return "get_task_subtasks", 200, {"data": subtasks}
+            return "get_task", 200, {"data": _project_fields(task, fields)}
+        if kind == "comment" and entity_id in data.comments:
+            return "get_comment", 200, {"data": data.comments[entity_id]}
+        if kind == "employee" and entity_id in data.employees:
+            return "get_employee", 200, {"data": data.employees[entity_id]}
+        return "unknown", 404, None
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _handle(self, method: str) -> None:
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                if server.latency:
+                    time.sleep(server.latency)
+                if server._throttled():
+                    endpoint, status, payload = "throttled", 429, {"error": "Too Many Requests"}
+                else:
+                    endpoint, status, payload = server._route(method, self.path, body)
+                encoded = json.dumps(payload or {}, ensure_ascii=False).encode("utf-8")
+                with server._lock:
+                    server.calls[endpoint] += 1
+                    server.bytes_sent += len(encoded)
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(encoded)))
+                if status == 429:
+                    self.send_header("Retry-After", "1")
+                self.end_headers()
+                self.wfile.write(encoded)
+
+            def do_GET(self) -> None:
+                self._handle("GET")
+
+            def do_POST(self) -> None:
+                self._handle("POST")
+
+            def log_message(self, format, *args) -> None:
+                pass
+
+        return Handler
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Fake Megaplan API v3 server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--projects", type=int, default=1, help="число проектов (ID: p1, p2, ...)")
+    parser.add_argument("--issues", type=int, default=100, help="задач линейки в каждом проекте")
+    parser.add_argument("--max-products", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.05, help="задержка ответа, секунды")
+    parser.add_argument("--rate-limit", type=float, default=0, help="запросов в секунду, 0 — без лимита")
+    args = parser.parse_args()
+
+    data = FakeMegaplanData()
+    for number in range(1, args.projects + 1):
+        data.add_project(f"p{number}", args.issues, max_products=args.max_products)
+    server = FakeMegaplanServer(data, args.host, args.port, args.latency, args.rate_limit)
+    print(f"Fake Megaplan listening on {server.url}, projects: {', '.join(data.projects)}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+"""Нагрузочный тест: всплески вебхуков /app/unloading-tasks против приложения и локального Megaplan.
+
+Приложение запускается отдельным процессом (uvicorn main:app) с настройками, указывающими на
+bench.fake_megaplan. Запуск из корня проекта:
+
+python -m bench.load_test --bursts 3 --burst-size 30 --distinct 10 --arrival-rate 50 --latency 0.05
+"""
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Sequence
+
+import requests
+
+from bench.fake_megaplan import FakeMegaplanData, FakeMegaplanServer
+
+JOB_FINISHED = ("done", "failed")
+
+
+def percentile(values: Sequence[float], percent: float) -> float:
+    """Перцентиль по методу ближайшего ранга; для пустого списка — 0."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(percent / 100 * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+
+def process_rss_mb(pid: int) -> float:
+    """RSS процесса и его дочерних процессов (пул сборки отчётов), по /proc; вне Linux — 0."""
+    total_kb = 0
+    pids = [pid]
+    while pids:
+        current = pids.pop()
+        try:
+            with open(f"/proc/{current}/status") as file:
+                match = re.search(r"^VmRSS:\s+(\d+)", file.read(), re.MULTILINE)
+            total_kb += int(match.group(1)) if match else 0
+            for task in os.listdir(f"/proc/{current}/task"):
+                with open(f"/proc/{current}/task/{task}/children") as file:
+                    pids.extend(int(child) for child in file.read().split())
+        except (FileNotFoundError, ProcessLookupError):
+            continue
+    return total_kb / 1024
+
+
+class AppProcess:
+    """Приложение в отдельном процессе, настроенное на фейковый Megaplan и временные каталоги."""
+
+    def __init__(self, megaplan_url: str, port: int, workdir: str, env: Dict[str, str]):
+        self.url = f"http://127.0.0.1:{port}"
+        self.port = port
+        self.env = {
+            **os.environ,
+            "MEGAPLAN_API_URL": megaplan_url,
+            "MEGAPLAN_API_KEY": "load-test",
+            "SNAPSHOT_DB_PATH": os.path.join(workdir, "snapshots.sqlite3"),
+            "REPORT_CACHE_DIR": os.path.join(workdir, "reports"),
+            "LOG_PATH": os.path.join(workdir, "project.log"),
+            **env,
+        }
+        self.process: Optional[subprocess.Popen] = None
+
+    def start(self, timeout: float = 30) -> "AppProcess":
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(self.port),
+             "--log-level", "warning"], env=self.env)
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                if requests.get(f"{self.url}/app/test", timeout=1).ok:
+                    return self
+            except requests.RequestException:
+                time.sleep(0.2)
+        self.stop()
+        raise RuntimeError("Приложение не запустилось")
+
+    def stop(self) -> None:
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+
+class Sampler(threading.Thread):
+    """Раз в interval снимает RSS приложения и метрики очереди выгрузок из /metrics."""
+
+    def __init__(self, app: AppProcess, interval: float = 0.1):
+        super().__init__(daemon=True)
+        self.app = app
+        self.interval = interval
+        self.peak_in_flight = 0.0
+        self.peak_queue_depth = 0.0
+        self.peak_rss_mb = 0.0
+        self.start_rss_mb = process_rss_mb(app.process.pid)
+        self._stopped = threading.Event()
+        self._session = requests.Session()
+
+    def _gauge(self, metrics: str, name: str) -> float:
+        match = re.search(rf"^{name} ([0-9.eE+-]+)$", metrics, re.MULTILINE)
+        return float(match.group(1)) if match else 0.0
+
+    def run(self) -> None:
+        while not self._stopped.is_set():
+            self.peak_rss_mb = max(self.peak_rss_mb, process_rss_mb(self.app.process.pid))
+            try:
+                metrics = self._session.get(f"{self.app.url}/metrics", timeout=5).text
+                self.peak_in_flight = max(self.peak_in_flight, self._gauge(metrics, "export_in_flight"))
+                self.peak_queue_depth = max(self.peak_queue_depth, self._gauge(metrics, "export_queue_depth"))
+            except requests.RequestException:
+                pass
+            self._stopped.wait(self.interval)
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self.join()
+
+
+def send_burst(app_url: str, entity_ids: List[str], arrival_rate: float, output_format: str) -> List[Dict]:
+    """Отправляет вебхуки всплеска с заданной частотой (0 — все сразу) и замеряет время приёма."""
+    session = requests.Session()
+
+    def send(entity_id: str) -> Dict:
+        started = time.perf_counter()
+        response = session.post(f"{app_url}/app/unloading-tasks", timeout=60,
+                                json={"entityType": "project", "entityId": entity_id, "format": output_format})
+        accepted = time.perf_counter()
+        return {"entityId": entity_id, "status": response.status_code, "acceptSeconds": accepted - started,
+                "jobId": response.json().get("jobId") if response.ok else None, "sentAt": time.monotonic()}
+
+    results = []
+    with ThreadPoolExecutor(max_workers=min(len(entity_ids), 64)) as executor:
+        futures = []
+        for index, entity_id in enumerate(entity_ids):
+            if arrival_rate and index:
+                time.sleep(1 / arrival_rate)
+            futures.append(executor.submit(send, entity_id))
+        results = [future.result() for future in futures]
+    return results
+
+
+def wait_for_jobs(app_url: str, job_ids: Sequence[str], timeout: float) -> Dict[str, Dict]:
+    """Опрашивает /app/jobs/{id}, пока все задачи не завершатся; отмечает время, когда это заметили."""
+    session = requests.Session()
+    jobs: Dict[str, Dict] = {}
+    deadline = time.monotonic() + timeout
+    while len(jobs) < len(job_ids) and time.monotonic() < deadline:
+        for job_id in job_ids:
+            if job_id in jobs:
+                continue
+            job = session.get(f"{app_url}/app/jobs/{job_id}", timeout=10).json()
+            if job.get("status") in JOB_FINISHED:
+                job["observedAt"] = time.monotonic()
+                jobs[job_id] = job
+        time.sleep(0.1)
+    return jobs
+
+
+def burst_entities(burst: int, size: int, distinct: int, projects: int) -> List[str]:
+    """ID проектов всплеска: distinct разных сущностей, остальные вебхуки — их повторы."""
+    distinct = max(1, min(distinct, size, projects))
+    offset = burst * distinct
+    return [f"p{(offset + index % distinct) % projects + 1}" for index in range(size)]
+
+
+def run_load_test(args: argparse.Namespace) -> Dict:
+    data = FakeMegaplanData()
+    projects = max(args.distinct * args.bursts, 1)
+    for number in range(1, projects + 1):
+        data.add_project(f"p{number}", args.issues, args.min_products, args.max_products)
+    server = FakeMegaplanServer(data, latency=args.latency, rate_limit=args.server_rate_limit).start()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        app = AppProcess(server.url, args.port, workdir, {
+            "EXPORT_WORKERS": str(args.workers),
+            "EXPORT_ISSUE_CONCURRENCY": str(args.concurrency),
+            "MEGAPLAN_RATE_LIMIT": str(args.client_rate),
+            "MEGAPLAN_RATE_BURST": str(max(1, int(args.client_rate))),
+        }).start()
+        sampler = Sampler(app)
+        sampler.start()
+        try:
+            accepted: List[Dict] = []
+            started = time.monotonic()
+            for burst in range(args.bursts):
+                if burst:
+                    time.sleep(args.burst_interval)
+                accepted += send_burst(app.url, burst_entities(burst, args.burst_size, args.distinct, projects),
+                                       args.arrival_rate, args.format)
+            job_ids = list(dict.fromkeys(result["jobId"] for result in accepted if result["jobId"]))
+            jobs = wait_for_jobs(app.url, job_ids, args.timeout)
+            finished = time.monotonic()
+        finally:
+            sampler.stop()
+            app.stop()
+            server.stop()
+
+    first_sent = {}
+    for result in accepted:
+        first_sent.setdefault(result["jobId"], result["sentAt"])
+    accept_latencies = [result["acceptSeconds"] for result in accepted]
+    completions = [job["observedAt"] - first_sent[job_id] for job_id, job in jobs.items()]
+    run_seconds = [job["runSeconds"] for job in jobs.values() if job.get("runSeconds") is not None]
+    wait_seconds = [job["waitSeconds"] for job in jobs.values()]
+    api_calls = [job["apiCalls"] for job in jobs.values() if job["status"] == "done"]
+    return {
+        "webhooks": len(accepted),
+        "rejected": sum(result["status"] != 200 for result in accepted),
+        "jobs": len(job_ids),
+        "coalesced": len(accepted) - len(job_ids),
+        "done": sum(job["status"] == "done" for job in jobs.values()),
+        "failed": sum(job["status"] == "failed" for job in jobs.values()),
+        "unfinished": len(job_ids) - len(jobs),
+        "accept_p50_ms": round(percentile(accept_latencies, 50) * 1000, 1),
+        "accept_p95_ms": round(percentile(accept_latencies, 95) * 1000, 1),
+        "accept_p99_ms": round(percentile(accept_latencies, 99) * 1000, 1),
+        "completion_p50_s": round(percentile(completions, 50), 2),
+        "completion_p95_s": round(percentile(completions, 95), 2),
+        "completion_max_s": round(max(completions, default=0), 2),
+        "wait_p95_s": round(percentile(wait_seconds, 95), 2),
+        "run_p50_s": round(percentile(run_seconds, 50), 2),
+        "total_s": round(finished - started, 2),
+        "peak_in_flight": int(sampler.peak_in_flight),
+        "peak_queue_depth": int(sampler.peak_queue_depth),
+        "start_rss_mb": round(sampler.start_rss_mb, 1),
+        "peak_rss_mb": round(sampler.peak_rss_mb, 1),
+        "api_calls_per_export": round(sum(api_calls) / len(api_calls), 1) if api_calls else 0,
+        "megaplan_calls": dict(server.calls),
+    }
+
+
+def print_report(result: Dict) -> None:
+    width = max(len(key) for key in result)
+    for key, value in result.items():
+        print(f"{key:>{width}}  {value}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Webhook burst load test against a fake Megaplan")
+    parser.add_argument("--bursts", type=int, default=3, help="число всплесков")
+    parser.add_argument("--burst-size", type=int, default=30, help="вебхуков во всплеске")
+    parser.add_argument("--distinct", type=int, default=10, help="разных сущностей во всплеске, остальные — повторы")
+    parser.add_argument("--arrival-rate", type=float, default=0, help="вебхуков в секунду внутри всплеска, 0 — все сразу")
+    parser.add_argument("--burst-interval", type=float, default=5, help="пауза между всплесками, секунды")
+    parser.add_argument("--issues", type=int, default=20, help="задач линейки в каждом проекте")
+    parser.add_argument("--min-products", type=int, default=1)
+    parser.add_argument("--max-products", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.05, help="задержка ответа Megaplan, секунды")
+    parser.add_argument("--server-rate-limit", type=float, default=0, help="лимит сервера, запросов в секунду")
+    parser.add_argument("--client-rate", type=float, default=50, help="MEGAPLAN_RATE_LIMIT приложения")
+    parser.add_argument("--workers", type=int, default=2, help="EXPORT_WORKERS приложения")
+    parser.add_argument("--concurrency", type=int, default=20, help="EXPORT_ISSUE_CONCURRENCY приложения")
+    parser.add_argument("--format", default="xlsx", help="формат файла: xlsx, csv, ndjson, parquet")
+    parser.add_argument("--port", type=int, default=8765, help="порт приложения")
+    parser.add_argument("--timeout", type=float, default=600, help="сколько ждать завершения выгрузок, секунды")
+    parser.add_argument("--json", help="сохранить результаты в JSON-файл")
+    args = parser.parse_args()
+
+    result = run_load_test(args)
+    print_report(result)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump({"args": vars(args), "result": result}, file, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
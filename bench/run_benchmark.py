@@ -0,0 +1,154 @@
+"""Офлайн-бенчмарк выгрузки: process_tasks_unloading против локального Megaplan.
+
+Запуск из корня проекта: python -m bench.run_benchmark --sizes 10 100 1000 --latency 0.05
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import resource
+import sys
+import time
+from typing import Dict, List
+
+from bench.fake_megaplan import FakeMegaplanData, FakeMegaplanServer
+
+
+def children_peak_rss_kb(pid: int) -> int:
+    """Сумма пиковых RSS (VmHWM) живых потомков процесса по /proc; вне Linux — 0."""
+    total_kb = 0
+    pids = []
+    try:
+        for task in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{task}/children") as file:
+                pids.extend(int(child) for child in file.read().split())
+    except (FileNotFoundError, ProcessLookupError):
+        return 0
+    for child in pids:
+        try:
+            with open(f"/proc/{child}/status") as file:
+                match = re.search(r"^VmHWM:\s+(\d+)", file.read(), re.MULTILINE)
+        except (FileNotFoundError, ProcessLookupError):
+            continue
+        total_kb += (int(match.group(1)) if match else 0) + children_peak_rss_kb(child)
+    return total_kb
+
+
+def peak_rss_mb() -> float:
+    """Пиковая память бенчмарка вместе с процессами пула сборки отчётов.
+
+    Воркеры пула живут до остановки конвейера, и RUSAGE_CHILDREN их ещё не учитывает,
+    поэтому для живых потомков берём VmHWM из /proc, а RUSAGE_CHILDREN — для завершившихся.
+    """
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    if sys.platform == "darwin":
+        # На macOS ru_maxrss в байтах, /proc нет
+        return (own + children) / (1024 * 1024)
+    # На Linux ru_maxrss в килобайтах
+    return (own + max(children, children_peak_rss_kb(os.getpid()))) / 1024
+
+
+def configure_environment(server_url: str, args: argparse.Namespace) -> None:
+    """Настройки приложения читаются при импорте, поэтому задаём их до импорта роутера."""
+    os.environ.update({
+        "MEGAPLAN_API_URL": server_url,
+        "MEGAPLAN_API_KEY": "benchmark",
+        "MEGAPLAN_RATE_LIMIT": str(args.client_rate),
+        "MEGAPLAN_RATE_BURST": str(max(1, int(args.client_rate))),
+        "EXPORT_ISSUE_CONCURRENCY": str(args.concurrency),
+        "SNAPSHOT_DB_PATH": args.snapshot_db,
+        # Бенчмарк не скачивает отчёты, кэш файлов ему не нужен
+        "REPORT_CACHE_DIR": "",
+    })
+
+
+async def run_exports(server: FakeMegaplanServer, data: FakeMegaplanData, project_ids: List[str],
+                      repeat: int, output_format: str = "xlsx") -> List[Dict]:
+    from prometheus_client import REGISTRY
+
+    from src.megaplan.client import megaplan_client
+    from src.routers.xlsx_router import process_tasks_unloading, render_pipeline
+
+    results = []
+    for project_id in project_ids:
+        for attempt in range(1, repeat + 1):
+            if attempt == 1:
+                # Каждый размер меряем с холодным кэшем
+                for cache in (megaplan_client.task_cache, megaplan_client.employee_cache,
+                              megaplan_client.comment_cache):
+                    cache.clear()
+            server.reset_stats()
+            uploads_before = len(server.uploads)
+            rows_before = REGISTRY.get_sample_value("export_rows_written_total")
+            started = time.perf_counter()
+            await process_tasks_unloading("project", project_id, output_format=output_format)
+            elapsed = time.perf_counter() - started
+            # Строки, действительно записанные в отчёт, а не ожидаемые по сгенерированным данным
+            rows = int(REGISTRY.get_sample_value("export_rows_written_total") - rows_before)
+            if rows != data.expected_rows[project_id]:
+                print(f"ВНИМАНИЕ: {project_id}: записано строк {rows}, ожидалось {data.expected_rows[project_id]}",
+                      file=sys.stderr)
+            upload_size = server.uploads[-1][1] if len(server.uploads) > uploads_before else 0
+            results.append({
+                "issues": len(data.project_issues[project_id]),
+                "attempt": attempt,
+                "rows": rows,
+                "expected_rows": data.expected_rows[project_id],
+                "wall_s": round(elapsed, 3),
+                "api_calls": sum(server.calls.values()),
+                "calls_by_endpoint": dict(server.calls),
+                "response_kb": round(server.bytes_sent / 1024, 1),
+                "upload_kb": round(upload_size / 1024, 1),
+                "rows_per_s": round(rows / elapsed, 1) if elapsed else 0,
+                "peak_rss_mb": round(peak_rss_mb(), 1),
+            })
+    await render_pipeline.stop()
+    return results
+
+
+def print_table(results: List[Dict]) -> None:
+    columns = ["issues", "attempt", "rows", "wall_s", "api_calls", "response_kb", "upload_kb", "rows_per_s",
+               "peak_rss_mb"]
+    print(" ".join(f"{column:>12}" for column in columns))
+    for result in results:
+        print(" ".join(f"{result[column]:>12}" for column in columns))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Offline export benchmark against a fake Megaplan")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000], help="число задач линейки")
+    parser.add_argument("--min-products", type=int, default=1)
+    parser.add_argument("--max-products", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.05, help="задержка ответа Megaplan, секунды")
+    parser.add_argument("--server-rate-limit", type=float, default=0, help="лимит сервера, запросов в секунду")
+    parser.add_argument("--client-rate", type=float, default=50, help="MEGAPLAN_RATE_LIMIT клиента")
+    parser.add_argument("--concurrency", type=int, default=20, help="EXPORT_ISSUE_CONCURRENCY")
+    parser.add_argument("--repeat", type=int, default=1, help="повторы каждого размера (тёплый кэш/снимок)")
+    parser.add_argument("--format", default="xlsx", help="формат файла: xlsx, csv, ndjson, parquet")
+    parser.add_argument("--snapshot-db", default="", help="путь к SQLite-снимку; по умолчанию снимок отключён")
+    parser.add_argument("--json", help="сохранить результаты в JSON-файл")
+    args = parser.parse_args()
+
+    data = FakeMegaplanData()
+    project_ids = []
+    for size in args.sizes:
+        project_id = f"bench-{size}"
+        data.add_project(project_id, size, args.min_products, args.max_products)
+        project_ids.append(project_id)
+    server = FakeMegaplanServer(data, latency=args.latency, rate_limit=args.server_rate_limit).start()
+    configure_environment(server.url, args)
+    try:
+        results = asyncio.run(run_exports(server, data, project_ids, args.repeat, args.format))
+    finally:
+        server.stop()
+
+    print_table(results)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump(results, file, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,6 +7,61 @@ class Settings(BaseSettings):
     MEGAPLAN_API_KEY: str
     MEGAPLAN_API_URL: str
 
+    # Размер пула keep-alive соединений с Megaplan (и число потоков ввода-вывода)
+    MEGAPLAN_POOL_SIZE: int = 10
+    MEGAPLAN_TIMEOUT: int = 120
+
+    # Общий для процесса лимит запросов к Megaplan (запросов в секунду и размер всплеска)
+    MEGAPLAN_RATE_LIMIT: float = 5.0
+    MEGAPLAN_RATE_BURST: int = 5
+    MEGAPLAN_MAX_RETRIES: int = 3
+
+    # Кэш сущностей Megaplan: время жизни записей (секунды) и максимальный размер каждого кэша
+    CACHE_EMPLOYEE_TTL: int = 3600
+    CACHE_TASK_TTL: int = 120
+    CACHE_COMMENT_TTL: int = 600
+    CACHE_MAX_SIZE: int = 2048
+
+    # Сколько запросов одной волны обхода иерархии задач линейки выполняется одновременно в рамках выгрузки
+    EXPORT_ISSUE_CONCURRENCY: int = 20
+    # Число одновременно выполняемых выгрузок и сколько завершённых задач хранить для /app/jobs
+    EXPORT_WORKERS: int = 2
+    EXPORT_JOB_HISTORY: int = 1000
+    # Писать в лог сводку трассы каждой выгрузки (этапы, самые долгие задачи и запросы)
+    EXPORT_TRACE_LOG: bool = False
+    # Снимок строк отчёта для инкрементальных выгрузок (пустой путь отключает снимок)
+    SNAPSHOT_DB_PATH: str = "/app/data/snapshots.sqlite3"
+    SNAPSHOT_MAX_AGE_DAYS: int = 90
+    # Повторы задачи линейки при временных ошибках Megaplan (экспоненциальная задержка от базовой)
+    EXPORT_ISSUE_RETRIES: int = 2
+    EXPORT_ISSUE_RETRY_BACKOFF: float = 2.0
+    # Отчёт собирается в памяти и сбрасывается на диск только если превысит этот размер (байты);
+    # отчёты, которые по оценке крупнее, собираются через временные файлы
+    EXPORT_SPOOL_MAX_SIZE: int = 32 * 1024 * 1024
+    # Сборка отчётов: процессов (0 — по числу ядер контейнера) и потоков для небольших отчётов,
+    # размер очереди отчётов, ожидающих сборки, и с какого числа строк отчёт собирается в отдельном
+    # процессе (отрицательное значение отключает пул процессов)
+    RENDER_PROCESSES: int = 0
+    RENDER_THREADS: int = 2
+    RENDER_QUEUE_SIZE: int = 4
+    RENDER_PROCESS_MIN_ROWS: int = 2000
+    # Кэш файлов, отданных через GET /app/unloading-tasks/...: каталог (пустой путь отключает кэш)
+    # и предельный суммарный размер в байтах
+    REPORT_CACHE_DIR: str = "/app/data/reports"
+    REPORT_CACHE_MAX_BYTES: int = 512 * 1024 * 1024
+    # Сколько скачиваний через GET /app/unloading-tasks/... одновременно загружают данные из Megaplan
+    # или собирают отчёт; остальные ждут своей очереди
+    DOWNLOAD_CONCURRENCY: int = 2
+    # Лог: путь к файлу, JSON-записи (иначе текст), размер очереди фоновой записи, предельная длина сообщения
+    # (ошибки не обрезаются) и доля выгрузок, для которых пишутся подробности по каждой задаче и запросу
+    LOG_PATH: str = "/app/logs/project.log"
+    LOG_JSON: bool = True
+    LOG_QUEUE_SIZE: int = 10000
+    LOG_MAX_MESSAGE_LENGTH: int = 2000
+    LOG_ENTITY_SAMPLE_RATE: float = 0.1
+    # Сколько разобранных описаний задач (списков продуктов) держать в кэше
+    PRODUCT_PARSER_CACHE_SIZE: int = 1024
+
     model_config = SettingsConfigDict(env_file=".env")
 
 
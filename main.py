@@ -1,5 +1,5 @@
 import logging
-from logging.handlers import RotatingFileHandler
+from contextlib import asynccontextmanager
 
 import uvicorn
 from fastapi import FastAPI
@@ -7,18 +7,34 @@ from fastapi.middleware.cors import CORSMiddleware
 from starlette.requests import Request
 from starlette.responses import JSONResponse
 
-from src.routers.xlsx_router import router as xlsx_router
+from config import settings
+from src.logging_setup import setup_logging
+from src.megaplan.client import megaplan_client
+from src.routers.metrics_router import router as metrics_router
+from src.routers.xlsx_router import export_scheduler, render_pipeline, router as xlsx_router, snapshot_store
 
-# Настройка логирования с ротацией по размеру файла
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
+# Логирование с ротацией по размеру файла; в файл пишет фоновый поток, чтобы не блокировать цикл событий
+log_listener = setup_logging(settings.LOG_PATH, max_bytes=10 * 1024 * 1024, backup_count=5,
+                             json_format=settings.LOG_JSON, queue_size=settings.LOG_QUEUE_SIZE,
+                             max_message_length=settings.LOG_MAX_MESSAGE_LENGTH,
+                             entity_sample_rate=settings.LOG_ENTITY_SAMPLE_RATE)
 
-handler = RotatingFileHandler('/app/logs/project.log', maxBytes=10 * 1024 * 1024, backupCount=5)
-handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
 
-logger.addHandler(handler)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    export_scheduler.start()
+    yield
+    await export_scheduler.stop()
+    await render_pipeline.stop()
+    # Закрываем пул соединений с Megaplan при остановке приложения
+    megaplan_client.close()
+    if snapshot_store:
+        snapshot_store.close()
+    # Дописываем оставшиеся в очереди записи лога
+    log_listener.stop()
 
-app = FastAPI()
+
+app = FastAPI(lifespan=lifespan)
 
 
 @app.exception_handler(Exception)
@@ -43,6 +59,7 @@ app.add_middleware(
 )
 
 app.include_router(xlsx_router)
+app.include_router(metrics_router)
 
 if __name__ == "__main__":
     uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
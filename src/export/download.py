@@ -0,0 +1,187 @@
+import asyncio
+import contextlib
+import hashlib
+import io
+import json
+import logging
+import os
+import tempfile
+import time
+from typing import AsyncIterator, BinaryIO, Optional
+
+from src.export.render import RenderPipeline, RenderRequest
+from src.export.writers import REPORT_WRITERS
+
+# Меняется при изменении оформления отчётов, чтобы старые файлы в кэше не отдавались
+REPORT_LAYOUT_VERSION = 1
+STREAM_CHUNK_SIZE = 64 * 1024
+# Недописанный файл кэша, который не менялся дольше этого времени (секунды), брошен упавшим процессом
+STALE_TEMP_AGE = 3600
+
+
+def report_fingerprint(request: RenderRequest) -> str:
+    """Отпечаток отчёта по загруженным данным: одинаковые данные дают одинаковый файл."""
+    payload = json.dumps([REPORT_LAYOUT_VERSION, request], ensure_ascii=False, default=str)
+    return hashlib.blake2b(payload.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class ReportCache:
+    """Кэш собранных отчётов на диске, ограниченный суммарным размером.
+
+    Файл называется по отпечатку данных; при переполнении удаляются давно не запрошенные файлы
+    (время последнего обращения хранится в mtime). Каталог создаётся при первой записи, а не при
+    создании объекта, чтобы импорт модуля не трогал диск.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._prepared = False
+
+    def _prepare(self) -> None:
+        if self._prepared:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        # Каталог могут делить несколько воркеров, поэтому удаляем только давно брошенные недописанные файлы
+        stale_before = time.time() - STALE_TEMP_AGE
+        for entry in os.scandir(self.directory):
+            try:
+                if entry.name.startswith(".") and entry.stat().st_mtime < stale_before:
+                    os.unlink(entry.path)
+            except FileNotFoundError:
+                pass
+        self._prepared = True
+
+    def _path(self, fingerprint: str, extension: str) -> str:
+        return os.path.join(self.directory, f"{fingerprint}.{extension}")
+
+    def get(self, fingerprint: str, extension: str) -> Optional[str]:
+        path = self._path(fingerprint, extension)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def create(self) -> BinaryIO:
+        """Временный файл для нового отчёта; после записи передаётся в commit или discard."""
+        self._prepare()
+        return tempfile.NamedTemporaryFile(dir=self.directory, prefix=".", suffix=".tmp", delete=False)
+
+    def commit(self, file: BinaryIO, fingerprint: str, extension: str) -> None:
+        file.close()
+        os.replace(file.name, self._path(fingerprint, extension))
+        self._evict()
+
+    @staticmethod
+    def discard(file: BinaryIO) -> None:
+        file.close()
+        try:
+            os.unlink(file.name)
+        except FileNotFoundError:
+            pass
+
+    def _evict(self) -> None:
+        entries = [entry for entry in os.scandir(self.directory) if not entry.name.startswith(".")]
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        total = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if total <= self.max_bytes:
+                break
+            total -= entry.stat().st_size
+            try:
+                os.unlink(entry.path)
+            except FileNotFoundError:
+                pass
+            logging.info(f"Отчёт {entry.name} удалён из кэша")
+
+
+class ReportStream(io.RawIOBase):
+    """Файл только на запись, который отдаёт собираемый отчёт клиенту частями.
+
+    Пишет в него поток сборки; части передаются в цикл событий через ограниченную очередь,
+    поэтому сборка ждёт, пока клиент не заберёт данные. Копия пишется в файл кэша.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, copy: Optional[BinaryIO] = None,
+                 chunk_size: int = STREAM_CHUNK_SIZE, max_chunks: int = 16):
+        super().__init__()
+        self.loop = loop
+        self.copy = copy
+        self.chunk_size = chunk_size
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_chunks)
+        self.aborted = False
+        self._buffer = bytearray()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        if self.aborted:
+            raise OSError("Клиент закрыл соединение")
+        self._buffer += data
+        if len(self._buffer) >= self.chunk_size:
+            chunk = bytes(self._buffer)
+            self._buffer.clear()
+            if self.copy is not None:
+                self.copy.write(chunk)
+            asyncio.run_coroutine_threadsafe(self.queue.put(chunk), self.loop).result()
+        return len(data)
+
+    async def finish(self) -> None:
+        """Отправляет остаток и признак конца; вызывается в цикле событий после сборки."""
+        if self.aborted:
+            return
+        if self._buffer:
+            chunk = bytes(self._buffer)
+            self._buffer.clear()
+            if self.copy is not None:
+                self.copy.write(chunk)
+            await self.queue.put(chunk)
+        await self.queue.put(None)
+
+    def abort(self) -> None:
+        # Освобождаем место в очереди, чтобы поток сборки не ждал вечно и получил ошибку на следующей записи
+        self.aborted = True
+        while not self.queue.empty():
+            self.queue.get_nowait()
+
+
+async def stream_report(pipeline: RenderPipeline, request: RenderRequest, fingerprint: str,
+                        cache: Optional[ReportCache] = None,
+                        slots: Optional[asyncio.Semaphore] = None) -> AsyncIterator[bytes]:
+    """Собирает отчёт и отдаёт его по частям; полностью отданный отчёт сохраняется в кэш.
+
+    slots ограничивает число одновременных сборок: сборка ждёт свободного места.
+    """
+    copy = cache.create() if cache is not None else None
+    stream = ReportStream(asyncio.get_running_loop(), copy)
+
+    async def render() -> int:
+        try:
+            async with slots or contextlib.nullcontext():
+                return await pipeline.render_to(request, stream)
+        finally:
+            await stream.finish()
+
+    rendering = asyncio.ensure_future(render())
+    completed = False
+    try:
+        while (chunk := await stream.queue.get()) is not None:
+            yield chunk
+        await rendering
+        completed = True
+    except Exception as e:
+        logging.exception(f"Ошибка потоковой выгрузки отчёта {fingerprint}: {e}")
+        raise
+    finally:
+        if not completed:
+            stream.abort()
+            # Ошибку сборки после разрыва соединения только забираем, чтобы она не попала в лог как необработанная
+            rendering.add_done_callback(lambda task: task.cancelled() or task.exception())
+        if copy is not None:
+            if completed:
+                cache.commit(copy, fingerprint, REPORT_WRITERS[request.output_format].extension)
+            else:
+                # Файл закрываем после того, как поток сборки перестанет в него писать
+                rendering.add_done_callback(lambda _: cache.discard(copy))
@@ -0,0 +1,171 @@
+import asyncio
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from src.logging_setup import entity_logger
+from src.metrics import wave_timer
+
+
+@dataclass(frozen=True)
+class NodeSpec:
+    """Узел иерархии задач: какую подзадачу родителя брать и какие поля у неё запрашивать.
+
+    Подзадача выбирается по имени — точному (name_equals) или по вхождению без учёта регистра
+    (name_contains). Узлы с batch=True загружаются одним запросом списка подзадач родителя,
+    причём сразу, как только известен ID родителя, не дожидаясь загрузки самого родителя.
+    fresh_fields — поля для сверки версий, когда узел читается минуя кэш; по умолчанию fields.
+    """
+    key: str
+    fields: Tuple[str, ...]
+    fresh_fields: Optional[Tuple[str, ...]] = None
+    name_equals: Optional[str] = None
+    name_contains: Optional[str] = None
+    batch: bool = False
+    children: Tuple["NodeSpec", ...] = ()
+
+    def matches(self, name: str) -> bool:
+        if self.name_equals is not None:
+            return name == self.name_equals
+        return self.name_contains is not None and self.name_contains in name.lower()
+
+    def find(self, tasks: Sequence[Dict]) -> Optional[Dict]:
+        return next((task for task in tasks if self.matches(task["name"])), None)
+
+
+@dataclass
+class TaskTree:
+    """Загруженная иерархия одной корневой задачи.
+
+    nodes — данные узлов по ключу NodeSpec.key; None — подзадачи нет, и её ветка не загружалась.
+    """
+    root: Dict
+    nodes: Dict[str, Optional[Dict]] = field(default_factory=dict)
+    error: Optional[Exception] = None
+    # Суммарное время запросов по этой задаче
+    elapsed: float = 0.0
+
+
+TaskLoader = Callable[[str, Sequence[str], bool], Awaitable[Dict]]
+SubtasksLoader = Callable[[str, Sequence[str]], Awaitable[List[Dict]]]
+
+
+class _Request(NamedTuple):
+    """Запрос волны: данные узла spec (batch=False) или список пакетных подзадач узла spec (batch=True)."""
+    tree: TaskTree
+    spec: NodeSpec
+    task_id: str
+    batch: bool
+
+
+class HierarchyPlanner:
+    """Обход иерархии в ширину: каждый уровень всех корневых задач загружается одной волной запросов.
+
+    Запрос ставится в ближайшую волну, в которой известен нужный для него ID, поэтому число
+    последовательных волн (глубина критического пути) зависит от глубины иерархии, а не от числа задач.
+    Ошибка запроса помечает только его корневую задачу; остальные её узлы не загружаются.
+    """
+
+    def __init__(self, spec: NodeSpec, load_task: TaskLoader, load_subtasks: SubtasksLoader,
+                 concurrency: int = 5):
+        self.spec = spec
+        self.load_task = load_task
+        self.load_subtasks = load_subtasks
+        self.concurrency = concurrency
+        # Число волн последнего обхода
+        self.depth = 0
+
+    async def run(self, roots: Sequence[Dict], loaded: Callable[[Dict], bool] = lambda root: False,
+                  fresh: Callable[[Dict], bool] = lambda root: False) -> List[TaskTree]:
+        """Загружает иерархии корневых задач.
+
+        loaded(root) — в данных корневой задачи уже есть нужные поля, и её не нужно запрашивать;
+        fresh(root) — узлы этой задачи читать минуя кэш.
+        """
+        trees = [TaskTree(root) for root in roots]
+        semaphore = asyncio.Semaphore(self.concurrency)
+        wave: List[_Request] = []
+        for tree in trees:
+            try:
+                if loaded(tree.root):
+                    self._loaded(tree, self.spec, tree.root, wave, list_batch=True)
+                else:
+                    self._discovered(tree, self.spec, tree.root["id"], wave)
+            except Exception as e:
+                tree.error = e
+
+        self.depth = 0
+        while wave:
+            self.depth += 1
+            next_wave: List[_Request] = []
+            with wave_timer(self.depth):
+                await asyncio.gather(*(self._fetch(request, next_wave, semaphore, fresh) for request in wave))
+            wave = [request for request in next_wave if request.tree.error is None]
+        return trees
+
+    @staticmethod
+    def _has_batch(spec: NodeSpec) -> bool:
+        return any(child.batch for child in spec.children)
+
+    def _discovered(self, tree: TaskTree, spec: NodeSpec, task_id: str, wave: List[_Request]) -> None:
+        # ID узла известен: в волну идут сам узел и, отдельным запросом, список его пакетных подзадач
+        wave.append(_Request(tree, spec, task_id, batch=False))
+        if self._has_batch(spec):
+            wave.append(_Request(tree, spec, task_id, batch=True))
+
+    def _loaded(self, tree: TaskTree, spec: NodeSpec, data: Dict, wave: List[_Request],
+                list_batch: bool = False) -> None:
+        tree.nodes[spec.key] = data
+        if list_batch and self._has_batch(spec):
+            wave.append(_Request(tree, spec, data["id"], batch=True))
+        for child in spec.children:
+            if child.batch:
+                continue
+            task = child.find(data.get("subTasks") or [])
+            if task is None:
+                # Ветки нет — её узлы не нужны
+                self._missing(tree, child)
+            else:
+                entity_logger.info("Получена задача %s с ID %s", task["name"], task["id"])
+                self._discovered(tree, child, task["id"], wave)
+
+    def _missing(self, tree: TaskTree, spec: NodeSpec) -> None:
+        tree.nodes[spec.key] = None
+        for child in spec.children:
+            self._missing(tree, child)
+
+    async def _fetch(self, request: _Request, next_wave: List[_Request], semaphore: asyncio.Semaphore,
+                     fresh: Callable[[Dict], bool]) -> None:
+        tree, spec = request.tree, request.spec
+        if tree.error is not None:
+            return
+        batch = [child for child in spec.children if child.batch]
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                if request.batch:
+                    fields = list(dict.fromkeys(name for child in batch for name in child.fields))
+                    subtasks = await self.load_subtasks(request.task_id, fields)
+                else:
+                    is_fresh = fresh(tree.root)
+                    fields = spec.fresh_fields if is_fresh and spec.fresh_fields is not None else spec.fields
+                    data = await self.load_task(request.task_id, list(fields), is_fresh)
+            except Exception as e:
+                tree.error = e
+                return
+            finally:
+                tree.elapsed += time.perf_counter() - started
+
+        try:
+            if not request.batch:
+                self._loaded(tree, spec, data, next_wave)
+                return
+            for child in batch:
+                task = child.find(subtasks)
+                if task is None:
+                    self._missing(tree, child)
+                else:
+                    self._loaded(tree, child, task, next_wave, list_batch=True)
+        except Exception as e:
+            # Нарушена структура данных узла
+            tree.error = e
@@ -0,0 +1,172 @@
+import asyncio
+import logging
+import time
+import uuid
+from collections import Counter, OrderedDict
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from src.megaplan.client import api_call_counter
+from src.metrics import EXPORT_DURATION, export_tracing
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+
+@dataclass
+class ExportJob:
+    entity_type: str
+    entity_id: str
+    # Сущности сводной выгрузки; пусто — выгружается сама entity_type/entity_id
+    sources: Tuple[Tuple[str, str], ...] = ()
+    output_format: str = "xlsx"
+    id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    status: str = JOB_QUEUED
+    queued_at: datetime = field(default_factory=datetime.now)
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+    # Сколько повторных вебхуков было объединено с этой задачей
+    coalesced: int = 0
+    api_calls: Counter = field(default_factory=Counter)
+    error: Optional[str] = None
+    # Монотонные отметки времени для расчёта длительностей
+    _queued: float = field(default_factory=time.monotonic, repr=False)
+    _started: float = field(default=0.0, repr=False)
+    _finished: float = field(default=0.0, repr=False)
+
+    @property
+    def key(self) -> Tuple:
+        return self.entity_type, self.entity_id, self.sources, self.output_format
+
+    def to_dict(self) -> Dict:
+        return {
+            "id": self.id,
+            "entityType": self.entity_type,
+            "entityId": self.entity_id,
+            "sources": [{"entityType": entity_type, "entityId": entity_id} for entity_type, entity_id in self.sources],
+            "format": self.output_format,
+            "status": self.status,
+            "queuedAt": self.queued_at.isoformat(),
+            "startedAt": self.started_at.isoformat() if self.started_at else None,
+            "finishedAt": self.finished_at.isoformat() if self.finished_at else None,
+            "waitSeconds": round((self._started or time.monotonic()) - self._queued, 3),
+            "runSeconds": round((self._finished or time.monotonic()) - self._started, 3) if self._started else None,
+            "coalesced": self.coalesced,
+            "apiCalls": self.api_calls["calls"],
+            "responseBytes": self.api_calls["bytes"],
+            "error": self.error,
+        }
+
+
+class ExportScheduler:
+    """Очередь выгрузок с фиксированным пулом воркеров.
+
+    Повторные запросы на одну и ту же сущность, пока её задача ещё в очереди, объединяются
+    в одну задачу. Если выгрузка уже идёт, ставится новая задача, так как данные могли измениться,
+    но воркеру она передаётся только после завершения текущей: две выгрузки одной сущности
+    одновременно не выполняются, а вебхуки, пришедшие за это время, объединяются с ожидающей задачей.
+    Воркеры и задачи хранятся в самом планировщике, поэтому сборщик мусора их не удалит.
+    """
+
+    def __init__(self, handler: Callable[..., Awaitable[None]], workers: int = 2,
+                 history_size: int = 1000, trace_log: bool = False):
+        self.handler = handler
+        self.workers_count = workers
+        self.history_size = history_size
+        self.trace_log = trace_log
+        self.jobs: "OrderedDict[str, ExportJob]" = OrderedDict()
+        self._pending: Dict[Tuple, ExportJob] = {}
+        # Ключи выполняющихся выгрузок и задачи, ждущие их завершения
+        self._running: Set[Tuple] = set()
+        self._deferred: Dict[Tuple, ExportJob] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+
+    def start(self) -> None:
+        if self._workers:
+            return
+        self._queue = asyncio.Queue()
+        self._workers = [asyncio.create_task(self._worker(), name=f"export-worker-{number}")
+                         for number in range(self.workers_count)]
+
+    async def stop(self) -> None:
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def submit(self, entity_type: str, entity_id: str, sources: Tuple[Tuple[str, str], ...] = (),
+               output_format: str = "xlsx") -> ExportJob:
+        self.start()
+        pending = self._pending.get((entity_type, entity_id, sources, output_format))
+        if pending is not None:
+            pending.coalesced += 1
+            logging.info(f"Выгрузка {entity_type} {entity_id} уже в очереди (задача {pending.id}), запрос объединён")
+            return pending
+
+        job = ExportJob(entity_type, entity_id, sources, output_format)
+        self._pending[job.key] = job
+        self.jobs[job.id] = job
+        self._trim_history()
+        if job.key in self._running:
+            self._deferred[job.key] = job
+            logging.info(f"Выгрузка {entity_type} {entity_id} уже выполняется, задача {job.id} ждёт её завершения")
+        else:
+            self._queue.put_nowait(job)
+        return job
+
+    def get(self, job_id: str) -> Optional[ExportJob]:
+        return self.jobs.get(job_id)
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._pending)
+
+    @property
+    def running(self) -> int:
+        return sum(job.status == JOB_RUNNING for job in self.jobs.values())
+
+    def _trim_history(self) -> None:
+        while len(self.jobs) > self.history_size:
+            oldest_id, oldest = next(iter(self.jobs.items()))
+            if oldest.status in (JOB_QUEUED, JOB_RUNNING):
+                break
+            del self.jobs[oldest_id]
+
+    async def _worker(self) -> None:
+        while True:
+            job = await self._queue.get()
+            self._pending.pop(job.key, None)
+            self._running.add(job.key)
+            job.status = JOB_RUNNING
+            job.started_at = datetime.now()
+            job._started = time.monotonic()
+            token = api_call_counter.set(job.api_calls)
+            with export_tracing(job.id) as trace:
+                try:
+                    await self.handler(job.entity_type, job.entity_id, job.sources, job.output_format)
+                    job.status = JOB_DONE
+                except asyncio.CancelledError:
+                    job.status = JOB_FAILED
+                    job.error = "cancelled"
+                    raise
+                except Exception as e:
+                    job.status = JOB_FAILED
+                    job.error = str(e)
+                    logging.error(f"Export job {job.id} failed: {e}")
+                finally:
+                    api_call_counter.reset(token)
+                    job.finished_at = datetime.now()
+                    job._finished = time.monotonic()
+                    self._queue.task_done()
+                    self._running.discard(job.key)
+                    deferred = self._deferred.pop(job.key, None)
+                    if deferred is not None:
+                        self._queue.put_nowait(deferred)
+                    EXPORT_DURATION.labels(status=job.status).observe(job._finished - job._started)
+                    logging.info(f"Задача выгрузки {job.id} завершена: {job.to_dict()}")
+                    if self.trace_log:
+                        logging.info(trace.summary())
@@ -0,0 +1,97 @@
+import functools
+import hashlib
+import html
+import re
+from collections import OrderedDict
+from typing import Tuple
+
+# Закрывающие теги блоков завершают строку
+BLOCK_TAGS = {"p", "div", "li", "ul", "ol", "tr", "table", "blockquote", "h1", "h2", "h3", "h4", "h5", "h6"}
+# Открывающие теги, перед которыми начинается новая строка (у <p> — нет, как и раньше)
+LINE_START_TAGS = {"div", "li", "tr", "blockquote", "h1", "h2", "h3", "h4", "h5", "h6"}
+
+# Мягкий перенос: перевод строки перед открывающим блоком, если строка ещё не пуста
+_SOFT_BREAK = "\x1e"
+# Пробелы и переносы между блоками незначимы и схлопываются в один перевод строки
+_SOFT_BREAK_RE = re.compile(r"[ \t\r\n]*\x1e[ \t\r\n\x1e]*")
+# Разметка целиком (комментарий или тег) — split по ней чередует текст и разметку
+_MARKUP_RE = re.compile(r"(<!--.*?-->|</?[a-zA-Z][^>]*>)", re.DOTALL)
+_TAG_NAME_RE = re.compile(r"<(/?)([a-zA-Z][a-zA-Z0-9]*)")
+_DIGIT_RE = re.compile(r"\d")
+
+# Теги, которые вставляет редактор Megaplan, снимаются строковыми replace до разбора регулярным выражением;
+# замены совпадают с _markup_replacement, остальная разметка обрабатывается общим путём
+_EDITOR_TAGS = (("<br />", "\n"), ("</p>", "\n"), ("<p>", ""), ("<strong>", ""), ("</strong>", ""))
+
+
+@functools.lru_cache(maxsize=512)
+def _markup_replacement(markup: str) -> str:
+    # Теги в описаниях повторяются, поэтому замена кэшируется по тексту тега
+    match = _TAG_NAME_RE.match(markup)
+    if match is None:
+        return ""
+    closing, name = match.groups()
+    name = name.lower()
+    if name == "br" or (closing and name in BLOCK_TAGS):
+        return "\n"
+    if not closing and name in LINE_START_TAGS:
+        return _SOFT_BREAK
+    return ""
+
+
+def html_to_text(text: str) -> str:
+    """Удаление HTML-тегов и декодирование символов.
+
+    <br> и границы блоков дают перевод строки, сущности декодируются после удаления тегов,
+    поэтому &lt;...&gt; остаётся текстом. Теги редактора снимаются replace, остальная разметка —
+    одним проходом регулярного выражения, только если она осталась.
+    """
+    for tag, replacement in _EDITOR_TAGS:
+        text = text.replace(tag, replacement)
+    parts = _MARKUP_RE.split(text) if "<" in text else ()
+    if len(parts) > 1:
+        parts[1::2] = map(_markup_replacement, parts[1::2])
+        text = "".join(parts)
+        if _SOFT_BREAK in text:
+            text = _SOFT_BREAK_RE.sub("\n", text)
+    if "&" in text:
+        text = html.unescape(text)
+    return text.strip()
+
+
+def split_products(text: str) -> Tuple[str, ...]:
+    """Продукты разделяются пустыми строками; если блок один и каждая строка начинается с цифры,
+    то продукт — каждая строка. Строки без цифр (заголовки) продуктами не считаются."""
+    # Лишние переводы строк дают пустые или начинающиеся с \n блоки, их отсекают strip и проверка на цифры
+    candidates = text.split("\n\n") if text else []
+    if len(candidates) == 1:
+        lines = candidates[0].split("\n")
+        if all(line.lstrip()[:1].isdigit() for line in lines):
+            candidates = lines
+    # Продукт обычно начинается с номера, поэтому регулярное выражение нужно редко
+    return tuple([candidate for candidate in map(str.strip, candidates)
+                  if candidate[:1].isdigit() or _DIGIT_RE.search(candidate)])
+
+
+class ProductParser:
+    """Разбор списка продуктов из HTML-описания задачи с LRU-кэшем по хэшу содержимого."""
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self._cache: "OrderedDict[bytes, Tuple[str, ...]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def parse(self, subject: str) -> Tuple[str, ...]:
+        key = hashlib.blake2b(subject.encode("utf-8"), digest_size=16).digest()
+        products = self._cache.get(key)
+        if products is not None:
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return products
+        self.misses += 1
+        products = split_products(html_to_text(subject))
+        self._cache[key] = products
+        if len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+        return products
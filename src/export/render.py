@@ -0,0 +1,200 @@
+import asyncio
+import io
+import logging
+import multiprocessing
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import BinaryIO, Dict, List, NamedTuple, Optional, Sequence, Tuple, Union
+
+from src.export.writers import REPORT_WRITERS, create_report_writer
+
+# Примерный объём строки отчёта в несжатом XML листа; по нему решаем, собирать ли отчёт целиком в памяти
+ROW_SIZE_ESTIMATE = 2 * 1024
+
+
+class SheetData(NamedTuple):
+    """Лист отчёта: название, ширины столбцов и строки без порядкового номера."""
+    title: str
+    column_widths: Dict[int, float]
+    rows: List[tuple]
+
+
+class RenderRequest(NamedTuple):
+    """Всё, что нужно для сборки отчёта, в виде простых данных, которые можно передать в другой процесс."""
+    output_format: str
+    sheets: List[SheetData]
+    # Строки сводного листа; None — сводный лист не нужен
+    summary: Optional[List[tuple]] = None
+    errors: Sequence[tuple] = ()
+
+    @property
+    def rows_count(self) -> int:
+        return sum(len(sheet.rows) for sheet in self.sheets)
+
+
+class RenderedReport(NamedTuple):
+    """Собранный отчёт: открытый на чтение файл с позицией в начале."""
+    file: BinaryIO
+    size: int
+    rows_written: int
+    extension: str
+    content_type: str
+
+
+def render_report(request: RenderRequest, target: Union[str, BinaryIO], in_memory: bool = False) -> int:
+    """Собирает отчёт в файл target (путь или файловый объект) и возвращает число строк.
+
+    in_memory — не использовать временные файлы при сборке (см. StreamingXlsxWriter).
+    Функция уровня модуля, чтобы её можно было выполнить в пуле процессов.
+    """
+    if isinstance(target, str):
+        with open(target, "wb") as file:
+            return render_report(request, file, in_memory)
+    writer = create_report_writer(request.output_format, target, in_memory)
+    if request.summary is not None:
+        writer.write_summary(request.summary)
+    for sheet in request.sheets:
+        writer.add_sheet(sheet.title, sheet.column_widths)
+        for values in sheet.rows:
+            writer.write_row(values)
+    if request.errors:
+        writer.write_errors(request.errors)
+    writer.close()
+    return writer.rows_written
+
+
+def render_report_bytes(request: RenderRequest) -> Tuple[bytes, int]:
+    """Собирает отчёт целиком в памяти и возвращает содержимое файла и число строк."""
+    buffer = io.BytesIO()
+    rows_written = render_report(request, buffer, in_memory=True)
+    return buffer.getvalue(), rows_written
+
+
+def available_cores() -> int:
+    # Учитываем ограничение по ядрам контейнера, если платформа его сообщает
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+class RenderPipeline:
+    """Этап сборки отчётов, отделённый от загрузки данных из Megaplan.
+
+    Выгрузки передают сюда готовые строки через ограниченную очередь: если сборка не успевает,
+    загрузка следующих выгрузок ждёт места в очереди. Крупные отчёты собираются в пуле процессов,
+    чтобы не занимать GIL и цикл событий, небольшие — в пуле потоков без затрат на передачу данных.
+
+    Отчёты, которые по оценке (ROW_SIZE_ESTIMATE) не больше spool_max_size, собираются без диска.
+    Более крупные идут через временные файлы: XML листов openpyxl и файл результата процесса.
+    """
+
+    def __init__(self, processes: int = 0, threads: int = 2, queue_size: int = 4, process_min_rows: int = 2000,
+                 spool_max_size: int = 32 * 1024 * 1024):
+        self.processes = processes or available_cores()
+        self.threads = threads
+        self.queue_size = queue_size
+        self.process_min_rows = process_min_rows
+        self.spool_max_size = spool_max_size
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+        self._process_pool: Optional[ProcessPoolExecutor] = None
+        self._thread_pool: Optional[ThreadPoolExecutor] = None
+
+    def start(self) -> None:
+        if self._workers:
+            return
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        if self.process_min_rows >= 0:
+            # spawn: родительский процесс многопоточный, fork в таком состоянии небезопасен
+            self._process_pool = ProcessPoolExecutor(max_workers=self.processes,
+                                                     mp_context=multiprocessing.get_context("spawn"))
+        self._thread_pool = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="render")
+        self._workers = [asyncio.create_task(self._worker(), name=f"render-worker-{number}")
+                         for number in range(self.processes + self.threads)]
+
+    async def stop(self) -> None:
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        if self._process_pool is not None:
+            self._process_pool.shutdown(cancel_futures=True)
+            self._process_pool = None
+        if self._thread_pool is not None:
+            self._thread_pool.shutdown(cancel_futures=True)
+            self._thread_pool = None
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def render(self, request: RenderRequest) -> RenderedReport:
+        """Ставит отчёт в очередь сборки и ждёт результат; файл результата закрывает вызывающий."""
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((request, future))
+        return await future
+
+    async def render_to(self, request: RenderRequest, target: BinaryIO) -> int:
+        """Собирает отчёт в пуле потоков прямо в target, минуя очередь (например, в поток ответа клиенту)."""
+        self.start()
+        return await asyncio.get_running_loop().run_in_executor(self._thread_pool, render_report, request, target,
+                                                                 self._fits_in_memory(request))
+
+    def _fits_in_memory(self, request: RenderRequest) -> bool:
+        return request.rows_count * ROW_SIZE_ESTIMATE <= self.spool_max_size
+
+    async def _worker(self) -> None:
+        while True:
+            request, future = await self._queue.get()
+            try:
+                if future.cancelled():
+                    continue
+                report = await self._render(request)
+                if future.cancelled():
+                    report.file.close()
+                else:
+                    future.set_result(report)
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except Exception as e:
+                if not future.cancelled():
+                    future.set_exception(e)
+            finally:
+                self._queue.task_done()
+
+    async def _render(self, request: RenderRequest) -> RenderedReport:
+        loop = asyncio.get_running_loop()
+        writer_class = REPORT_WRITERS[request.output_format]
+        in_memory = self._fits_in_memory(request)
+        if self._process_pool is not None and request.rows_count >= self.process_min_rows:
+            if in_memory:
+                # Готовый файл возвращается из процесса байтами через канал пула, минуя диск
+                content, rows_written = await loop.run_in_executor(self._process_pool, render_report_bytes, request)
+                file, size = io.BytesIO(content), len(content)
+            else:
+                # Процесс пишет во временный файл; после открытия на чтение файл сразу удаляется
+                descriptor, path = tempfile.mkstemp(suffix=f".{writer_class.extension}")
+                os.close(descriptor)
+                try:
+                    rows_written = await loop.run_in_executor(self._process_pool, render_report, request, path)
+                    file = open(path, "rb")
+                finally:
+                    os.unlink(path)
+                size = os.fstat(file.fileno()).st_size
+            logging.info(f"Отчёт на {rows_written} строк собран в отдельном процессе")
+        else:
+            # Отчёт собираем в памяти; на диск он попадёт, только если превысит spool_max_size
+            file = tempfile.SpooledTemporaryFile(max_size=self.spool_max_size)
+            rendering = loop.run_in_executor(self._thread_pool, render_report, request, file, in_memory)
+            try:
+                rows_written = await asyncio.shield(rendering)
+            except BaseException:
+                # Поток может ещё писать в файл, поэтому закрываем его только после завершения сборки
+                rendering.add_done_callback(lambda _: file.close())
+                raise
+            size = file.tell()
+            file.seek(0)
+        return RenderedReport(file, size, rows_written, writer_class.extension, writer_class.content_type)
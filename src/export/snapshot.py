@@ -0,0 +1,105 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+# Отметка для отсутствующей подзадачи или комментария, чтобы отличать её от неизвестной версии (None)
+ABSENT = "-"
+
+
+def modification_marker(entity: Optional[Dict]) -> Optional[str]:
+    """Возвращает отметку изменения сущности Megaplan (timeUpdated, иначе activity)."""
+    if not entity:
+        return ABSENT
+    value = entity.get("timeUpdated") or entity.get("activity")
+    if isinstance(value, dict):
+        value = value.get("value")
+    return value
+
+
+@dataclass
+class IssueSnapshot:
+    versions: Dict[str, Optional[str]]
+    rows: List[tuple]
+
+    def matches(self, versions: Dict[str, Optional[str]]) -> bool:
+        """Снимок годен, только если все версии известны и совпадают с текущими."""
+        return None not in versions.values() and versions == self.versions
+
+
+class SnapshotStore:
+    """Локальный SQLite-снимок строк отчёта по задачам линейки.
+
+    Для каждой задачи хранятся готовые строки и версии связанных сущностей
+    (задача линейки, разработка продуктов, поставщики сырья и упаковки, последний комментарий).
+    Задачи сохраняются по мере сборки, поэтому выгрузка, прерванная временной ошибкой, при повторе
+    берёт уже собранные задачи из снимка — после той же сверки версий, что и любая другая выгрузка.
+
+    Запросы к базе выполняются в отдельном потоке, чтобы не блокировать цикл событий;
+    снимки выгрузки читаются одним запросом и записываются одной транзакцией.
+    """
+
+    def __init__(self, path: str, max_age_days: int = 90):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Соединение используется только из потока self._executor
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS issue_snapshot ("
+            "issue_id TEXT PRIMARY KEY, versions TEXT NOT NULL, rows TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self.connection.commit()
+        self.prune(max_age_days)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="snapshot")
+
+    async def _run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+
+    async def get_many(self, issue_ids: Sequence[str]) -> Dict[str, IssueSnapshot]:
+        return await self._run(self._get_many, list(issue_ids))
+
+    def _get_many(self, issue_ids: List[str]) -> Dict[str, IssueSnapshot]:
+        snapshots = {}
+        # Ограничение SQLite на число параметров запроса
+        for start in range(0, len(issue_ids), 500):
+            chunk = issue_ids[start:start + 500]
+            cursor = self.connection.execute(
+                f"SELECT issue_id, versions, rows FROM issue_snapshot WHERE issue_id IN ({','.join('?' * len(chunk))})",
+                chunk)
+            for issue_id, versions, rows in cursor:
+                snapshots[issue_id] = IssueSnapshot(json.loads(versions),
+                                                    [tuple(values) for values in json.loads(rows)])
+        return snapshots
+
+    async def save_many(self, entries: Iterable[Tuple[str, Dict[str, Optional[str]], List[tuple]]]) -> None:
+        """Сохраняет снимки (ID задачи, версии, строки) одной транзакцией."""
+        entries = list(entries)
+        if entries:
+            await self._run(self._save_many, entries)
+
+    def _save_many(self, entries: List[Tuple[str, Dict[str, Optional[str]], List[tuple]]]) -> None:
+        now = time.time()
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO issue_snapshot (issue_id, versions, rows, updated_at) VALUES (?, ?, ?, ?)",
+                [(issue_id, json.dumps(versions, ensure_ascii=False), json.dumps(rows, ensure_ascii=False), now)
+                 # Без версий снимок нельзя будет проверить, поэтому не сохраняем его
+                 for issue_id, versions, rows in entries if None not in versions.values()])
+
+    def prune(self, max_age_days: int) -> None:
+        cursor = self.connection.execute(
+            "DELETE FROM issue_snapshot WHERE updated_at < ?", (time.time() - max_age_days * 86400,))
+        self.connection.commit()
+        if cursor.rowcount:
+            logging.info(f"Удалено устаревших снимков задач: {cursor.rowcount}")
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True)
+        self.connection.close()
@@ -0,0 +1,170 @@
+import abc
+import csv
+import io
+import json
+from typing import BinaryIO, Dict, Iterable, List, Optional, Sequence
+
+from src.export.xlsx_writer import REPORT_HEADERS, StreamingXlsxWriter
+
+# Дополнительный столбец плоских форматов: у задач, которые не удалось выгрузить, в нём описание ошибки
+ERROR_COLUMN = "Ошибка"
+
+try:
+    import pyarrow
+    import pyarrow.parquet as parquet
+except ImportError:  # Parquet доступен только при установленном pyarrow
+    pyarrow = None
+    parquet = None
+
+
+class XlsxReportWriter(StreamingXlsxWriter):
+    """Стилизованный xlsx; файл собирается при close()."""
+
+    extension = "xlsx"
+    content_type = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    # Где в файле искать задачи с ошибками (для комментария к выгрузке)
+    errors_hint = "см. лист «Ошибки»"
+
+    def __init__(self, target: BinaryIO, in_memory: bool = False):
+        super().__init__(in_memory=in_memory)
+        self.target = target
+
+    def close(self) -> None:
+        self.save(self.target)
+
+
+class _FlatReportWriter(abc.ABC):
+    """Основа для плоских форматов: все листы идут одним потоком строк со сквозной нумерацией.
+
+    Сводный лист не пишется. Задачи, которые не удалось выгрузить, идут в конце строками без номера
+    с брендом, линейкой и описанием ошибки в столбце ERROR_COLUMN; у остальных строк он пустой.
+    """
+
+    extension = ""
+    content_type = ""
+    errors_hint = f"см. строки с заполненным столбцом «{ERROR_COLUMN}»"
+
+    def __init__(self, target: BinaryIO):
+        self.target = target
+        self.headers: Optional[List[str]] = None
+        self.rows_written = 0
+
+    def add_sheet(self, title: str, column_widths: Dict[int, float],
+                  headers: Sequence[str] = REPORT_HEADERS) -> None:
+        if self.headers is None:
+            self.headers = [*headers, ERROR_COLUMN]
+            self._write_header()
+
+    def write_summary(self, entries: Iterable[Sequence], title: str = "Сводка") -> None:
+        pass
+
+    def write_errors(self, entries: Iterable[Sequence], title: str = "Ошибки") -> None:
+        """Пишет строки ошибок (бренд, линейка, описание) с пустыми столбцами данных."""
+        if self.headers is None:
+            self.add_sheet(title, {})
+        empty = (None,) * (len(self.headers) - 4)
+        for brand, line, error in entries:
+            self._write_values((None, brand, line, *empty, error))
+
+    def write_row(self, values: Sequence) -> None:
+        self.rows_written += 1
+        self._write_values((self.rows_written, *values, None))
+
+    def _write_header(self) -> None:
+        pass
+
+    @abc.abstractmethod
+    def _write_values(self, values: Sequence) -> None:
+        """Записывает строку в том виде, в каком она попадёт в файл: номер, значения, ошибка."""
+
+    def close(self) -> None:
+        pass
+
+
+class CsvReportWriter(_FlatReportWriter):
+    """CSV в UTF-8 с BOM, чтобы кириллица корректно открывалась в Excel."""
+
+    extension = "csv"
+    content_type = "text/csv"
+
+    def __init__(self, target: BinaryIO):
+        super().__init__(target)
+        self._stream = io.TextIOWrapper(target, encoding="utf-8-sig", newline="")
+        self._writer = csv.writer(self._stream)
+
+    def _write_header(self) -> None:
+        self._writer.writerow(self.headers)
+
+    def _write_values(self, values: Sequence) -> None:
+        self._writer.writerow(values)
+
+    def close(self) -> None:
+        self._stream.flush()
+        # Отсоединяем обёртку, чтобы она не закрыла буфер
+        self._stream.detach()
+
+
+class NdjsonReportWriter(_FlatReportWriter):
+    """JSON Lines: одна строка отчёта — один объект с ключами по заголовкам столбцов."""
+
+    extension = "ndjson"
+    content_type = "application/x-ndjson"
+
+    def _write_values(self, values: Sequence) -> None:
+        record = dict(zip(self.headers, values))
+        self.target.write(json.dumps(record, ensure_ascii=False).encode("utf-8") + b"\n")
+
+
+class ParquetReportWriter(_FlatReportWriter):
+    """Колоночный Parquet; строки пишутся группами по batch_size."""
+
+    extension = "parquet"
+    content_type = "application/vnd.apache.parquet"
+
+    def __init__(self, target: BinaryIO, batch_size: int = 10000):
+        super().__init__(target)
+        self.batch_size = batch_size
+        self._batch: List[Sequence] = []
+        self._writer = None
+
+    def _write_header(self) -> None:
+        fields = [pyarrow.field(self.headers[0], pyarrow.int64())]
+        fields += [pyarrow.field(header, pyarrow.string()) for header in self.headers[1:]]
+        self._schema = pyarrow.schema(fields)
+        self._writer = parquet.ParquetWriter(self.target, self._schema, compression="zstd")
+
+    def _write_values(self, values: Sequence) -> None:
+        self._batch.append(values)
+        if len(self._batch) >= self.batch_size:
+            self._flush()
+
+    def _flush(self) -> None:
+        if not self._batch:
+            return
+        columns = [[values[0] for values in self._batch]]
+        columns += [[None if value is None else str(value) for value in column]
+                    for column in list(zip(*self._batch))[1:]]
+        self._writer.write_table(pyarrow.Table.from_arrays(columns, schema=self._schema))
+        self._batch = []
+
+    def close(self) -> None:
+        if self._writer is None:
+            self.add_sheet("", {})
+        self._flush()
+        self._writer.close()
+
+
+REPORT_WRITERS = {
+    "xlsx": XlsxReportWriter,
+    "csv": CsvReportWriter,
+    "ndjson": NdjsonReportWriter,
+}
+if pyarrow is not None:
+    REPORT_WRITERS["parquet"] = ParquetReportWriter
+
+
+def create_report_writer(output_format: str, target: BinaryIO, in_memory: bool = False):
+    """in_memory — собирать xlsx без временных файлов; плоские форматы и так пишут прямо в target."""
+    if output_format == "xlsx":
+        return XlsxReportWriter(target, in_memory=in_memory)
+    return REPORT_WRITERS[output_format](target)
@@ -0,0 +1,170 @@
+import io
+from typing import BinaryIO, Dict, Iterable, List, Optional, Sequence, Union
+from zipfile import ZIP_DEFLATED, ZipFile
+
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.drawing.spreadsheet_drawing import SpreadsheetDrawing
+from openpyxl.styles import Alignment, Border, Font, NamedStyle, PatternFill, Side
+from openpyxl.utils import get_column_letter
+from openpyxl.worksheet._writer import WorksheetWriter
+from openpyxl.writer.excel import ExcelWriter
+
+REPORT_HEADERS = ["№", "Бренд", "Линейка", "Наименование", "Дата запуска работы", "Ответственный БМ",
+                  "Ответственный ОЗ", "Сырье", "Упаковка", "Примечание"]
+SUMMARY_HEADERS = ["№", "Бренд", "Ответственный БМ", "Линеек", "Продуктов"]
+SUMMARY_COLUMN_WIDTHS = {1: 5, 2: 40, 3: 30, 4: 12, 5: 12}
+ERROR_HEADERS = ["№", "Бренд", "Линейка", "Ошибка"]
+ERROR_COLUMN_WIDTHS = {1: 5, 2: 30, 3: 40, 4: 80}
+
+# Ограничения Excel на имя листа
+SHEET_TITLE_MAX_LENGTH = 31
+SHEET_TITLE_FORBIDDEN = str.maketrans({char: " " for char in "[]:*?/\\"})
+
+MAX_COLUMN_WIDTH = 50  # Максимальная ширина в символах
+# Фиксированная ширина: №, Наименование и столбцы сырье/упаковка/примечание
+FIXED_COLUMN_WIDTHS = {1: 5, 4: MAX_COLUMN_WIDTH, 8: MAX_COLUMN_WIDTH, 9: MAX_COLUMN_WIDTH, 10: MAX_COLUMN_WIDTH}
+
+
+def _build_named_styles() -> List[NamedStyle]:
+    thin = Side(style='thin')
+    header = NamedStyle(name="report_header")
+    header.fill = PatternFill(start_color="FFEB84", end_color="FFEB84", fill_type="solid")  # Жёлтый цвет
+    header.font = Font(bold=True)
+    header.alignment = Alignment(horizontal='center', vertical='center', wrap_text=True)
+    header.border = Border(left=thin, right=thin, top=thin, bottom=thin)
+
+    center = NamedStyle(name="report_center")
+    center.alignment = Alignment(horizontal="center", vertical="center")
+
+    product = NamedStyle(name="report_product")
+    product.alignment = Alignment(wrap_text=True, horizontal="left", vertical="center")
+
+    # Перенос текста для столбцов сырье/упаковка/примечание
+    note = NamedStyle(name="report_note")
+    note.alignment = Alignment(wrap_text=True, vertical='top')
+    return [header, center, product, note]
+
+
+# Стиль ячеек данных по номеру столбца (1-based)
+COLUMN_STYLES = ["report_center", "report_center", "report_center", "report_product", "report_center",
+                 "report_center", "report_center", "report_note", "report_note", "report_note"]
+
+
+class ColumnWidthTracker:
+    """Подбирает ширину столбцов по мере поступления строк, без повторного прохода по листу."""
+
+    def __init__(self, headers: Sequence[str] = REPORT_HEADERS):
+        self._lengths = [len(str(header)) for header in headers]
+
+    def update(self, values: Sequence) -> None:
+        """Учитывает строку данных без порядкового номера (как в StreamingXlsxWriter.write_row)."""
+        for index, value in enumerate(values, 1):
+            length = len(str(value))
+            if length > self._lengths[index]:
+                self._lengths[index] = length
+
+    def update_many(self, rows: Iterable[Sequence]) -> None:
+        for values in rows:
+            self.update(values)
+
+    def widths(self) -> Dict[int, int]:
+        return {
+            column: FIXED_COLUMN_WIDTHS.get(column, min(length + 2, MAX_COLUMN_WIDTH))
+            for column, length in enumerate(self._lengths, 1)
+        }
+
+
+class _InMemoryExcelWriter(ExcelWriter):
+    """ExcelWriter, который берёт XML листов из памяти, а не из временных файлов openpyxl."""
+
+    def write_worksheet(self, ws):
+        ws._drawing = SpreadsheetDrawing()
+        ws._drawing.charts = ws._charts
+        ws._drawing.images = ws._images
+        if not ws.closed:
+            ws.close()
+        ws._rels = ws._writer._rels
+        self._archive.writestr(ws.path[1:], ws._writer.read())
+        self.manifest.append(ws)
+
+
+class StreamingXlsxWriter:
+    """Потоковая запись отчёта через write-only листы openpyxl.
+
+    Строки сразу сериализуются в XML листа, поэтому объекты ячеек не копятся в памяти.
+    openpyxl пишет этот XML во временный файл на диске; при in_memory=True XML листов
+    держится в памяти и сразу упаковывается в target — для отчётов, которые заведомо
+    помещаются в память. Стили заданы один раз как именованные и разделяются всеми ячейками.
+    В write-only режиме ширину столбцов нужно задать до первой строки, поэтому она
+    передаётся при создании листа (см. ColumnWidthTracker). Листы заполняются по очереди:
+    write_row пишет в последний созданный лист.
+    """
+
+    def __init__(self, column_widths: Optional[Dict[int, float]] = None, title: str = "Задачи",
+                 headers: Sequence[str] = REPORT_HEADERS, in_memory: bool = False):
+        self.in_memory = in_memory
+        self.workbook = Workbook(write_only=True)
+        for style in _build_named_styles():
+            self.workbook.add_named_style(style)
+        self.sheet = None
+        self.rows_written = 0
+        self.sheet_rows = 0
+        self._titles = set()
+        if column_widths is not None:
+            self.add_sheet(title, column_widths, headers)
+
+    def _unique_title(self, title: str) -> str:
+        base = title.translate(SHEET_TITLE_FORBIDDEN).strip() or "Лист"
+        candidate, suffix = base[:SHEET_TITLE_MAX_LENGTH], 1
+        while candidate.lower() in self._titles:
+            suffix += 1
+            tail = f" ({suffix})"
+            candidate = base[:SHEET_TITLE_MAX_LENGTH - len(tail)] + tail
+        self._titles.add(candidate.lower())
+        return candidate
+
+    def add_sheet(self, title: str, column_widths: Dict[int, float],
+                  headers: Sequence[str] = REPORT_HEADERS) -> None:
+        self.sheet = self.workbook.create_sheet(self._unique_title(title))
+        for column, width in column_widths.items():
+            self.sheet.column_dimensions[get_column_letter(column)].width = width
+        if self.in_memory:
+            # Свой writer листа до первой строки, иначе openpyxl создаст временный файл
+            self.sheet._writer = WorksheetWriter(self.sheet, out=io.BytesIO())
+            self.sheet._writer.write_top()
+        self.sheet_rows = 0
+        self.sheet.append([self._cell(header, "report_header") for header in headers])
+
+    def write_summary(self, entries: Iterable[Sequence], title: str = "Сводка") -> None:
+        """Добавляет сводный лист: бренд, ответственный БМ, число линеек и продуктов."""
+        self.add_sheet(title, SUMMARY_COLUMN_WIDTHS, SUMMARY_HEADERS)
+        for number, values in enumerate(entries, 1):
+            self.sheet.append([self._cell(value, "report_center") for value in (number, *values)])
+
+    def _cell(self, value, style: str) -> WriteOnlyCell:
+        cell = WriteOnlyCell(self.sheet, value=value)
+        cell.style = style
+        return cell
+
+    def write_errors(self, entries: Iterable[Sequence], title: str = "Ошибки") -> None:
+        """Добавляет лист с задачами, которые не удалось выгрузить: бренд, линейка, описание ошибки."""
+        self.add_sheet(title, ERROR_COLUMN_WIDTHS, ERROR_HEADERS)
+        for number, values in enumerate(entries, 1):
+            self.sheet.append([self._cell(number, "report_center")] +
+                              [self._cell(value, "report_note") for value in values])
+
+    def write_row(self, values: Sequence) -> None:
+        """Записывает строку данных; порядковый номер в пределах листа подставляется автоматически."""
+        self.rows_written += 1
+        self.sheet_rows += 1
+        self.sheet.append([self._cell(value, style)
+                           for value, style in zip((self.sheet_rows, *values), COLUMN_STYLES)])
+
+    def save(self, target: Union[str, BinaryIO]) -> None:
+        if not self.in_memory:
+            self.workbook.save(target)
+            return
+        if not self.workbook.worksheets:
+            self.add_sheet("Лист", {})
+        _InMemoryExcelWriter(self.workbook, ZipFile(target, "w", ZIP_DEFLATED, allowZip64=True)).save()
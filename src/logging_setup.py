@@ -0,0 +1,140 @@
+import copy
+import json
+import logging
+import queue
+import random
+import zlib
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Any, Callable, Optional
+
+from src.metrics import LOG_RECORDS_DROPPED, export_trace
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - [%(job_id)s] %(message)s'
+
+# Подробные записи по отдельным задачам, комментариям и запросам к Megaplan; пишутся выборочно
+entity_logger = logging.getLogger("export.entities")
+
+
+class Lazy:
+    """Аргумент записи лога, который вычисляется, только если запись действительно будет выведена."""
+
+    __slots__ = ("function", "args")
+
+    def __init__(self, function: Callable[..., Any], *args: Any):
+        self.function = function
+        self.args = args
+
+    def __str__(self) -> str:
+        return str(self.function(*self.args))
+
+
+def current_job_id() -> Optional[str]:
+    trace = export_trace.get()
+    return trace.job_id if trace is not None else None
+
+
+class JobContextFilter(logging.Filter):
+    """Добавляет к записи ID выгрузки; выполняется в потоке, создавшем запись, где доступен контекст."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not hasattr(record, "job_id"):
+            record.job_id = current_job_id()
+        return True
+
+
+class EntitySampler(logging.Filter):
+    """Пропускает подробные записи только для доли выгрузок sample_rate; предупреждения и ошибки — всегда.
+
+    Выборка делается по ID выгрузки, поэтому попавшая в неё выгрузка видна в логе целиком.
+    """
+
+    def __init__(self, sample_rate: float):
+        super().__init__()
+        self.sample_rate = sample_rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or self.sample_rate >= 1:
+            return True
+        if self.sample_rate <= 0:
+            return False
+        job_id = current_job_id()
+        if job_id is None:
+            return random.random() < self.sample_rate
+        return zlib.crc32(job_id.encode()) % 10000 < self.sample_rate * 10000
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """Передаёт записи фоновому потоку записи, не блокируя цикл событий.
+
+    Текст сообщения собирается сразу (аргументы могут измениться позже) и обрезается до
+    max_message_length; форматирование трассировки и запись в файл выполняет QueueListener.
+    При переполнении очереди записи ниже ERROR отбрасываются, ошибки ждут места в очереди.
+    """
+
+    def __init__(self, log_queue: queue.Queue, max_message_length: int = 2000, error_timeout: float = 1.0):
+        super().__init__(log_queue)
+        self.max_message_length = max_message_length
+        self.error_timeout = error_timeout
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        message = record.getMessage()
+        # Ошибки не обрезаются, чтобы не потерять подробности
+        if record.levelno < logging.ERROR and len(message) > self.max_message_length:
+            message = f"{message[:self.max_message_length]}… [обрезано, всего {len(message)} символов]"
+        record.msg = message
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            if record.levelno >= logging.ERROR:
+                self.queue.put(record, timeout=self.error_timeout)
+            else:
+                self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc()
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись — одна строка JSON с ID выгрузки."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "jobId": getattr(record, "job_id", None),
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        if record.stack_info:
+            entry["stack"] = self.formatStack(record.stack_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def setup_logging(path: str, max_bytes: int = 10 * 1024 * 1024, backup_count: int = 5, json_format: bool = True,
+                  queue_size: int = 10000, max_message_length: int = 2000,
+                  entity_sample_rate: float = 0.1) -> QueueListener:
+    """Подключает к корневому логгеру очередь с фоновой записью в файл с ротацией.
+
+    Возвращает запущенный QueueListener; при остановке приложения его нужно остановить,
+    чтобы дописать оставшиеся в очереди записи.
+    """
+    file_handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count)
+    file_handler.setFormatter(JsonFormatter() if json_format else logging.Formatter(TEXT_FORMAT))
+
+    log_queue: queue.Queue = queue.Queue(maxsize=queue_size)
+    handler = NonBlockingQueueHandler(log_queue, max_message_length)
+    handler.addFilter(JobContextFilter())
+
+    logger = logging.getLogger()
+    logger.setLevel(logging.INFO)
+    logger.addHandler(handler)
+    entity_logger.addFilter(EntitySampler(entity_sample_rate))
+
+    listener = QueueListener(log_queue, file_handler, respect_handler_level=True)
+    listener.start()
+    return listener
@@ -0,0 +1,230 @@
+import asyncio
+import functools
+import json
+import logging
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from typing import Any, BinaryIO, Dict, List, Optional, Sequence
+from urllib.parse import quote
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from config import settings
+from src.megaplan.cache import EntityCache
+from src.logging_setup import entity_logger
+from src.metrics import MEGAPLAN_REQUEST_DURATION, MEGAPLAN_REQUEST_ERRORS, export_trace
+from src.megaplan.multipart import MultipartFileStream
+from src.megaplan.rate_limiter import AdaptiveRateLimiter, parse_retry_after
+
+XLSX_CONTENT_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+# Статусы, после которых запрос повторяется с замедлением
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Неидемпотентные запросы повторяем только если сервер точно их не обработал
+RETRY_STATUSES_UNSAFE = {429, 503}
+
+# Счётчик HTTP-запросов ("calls") и байт ответов ("bytes") текущей выгрузки;
+# задачи asyncio наследуют его из контекста
+api_call_counter: ContextVar[Optional[Counter]] = ContextVar("api_call_counter", default=None)
+
+
+def is_transient_error(error: BaseException) -> bool:
+    """Ошибки сети, таймауты, 429 и 5xx считаются временными: запрос имеет смысл повторить позже."""
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return error.response.status_code == 429 or error.response.status_code >= 500
+    return isinstance(error, (requests.ConnectionError, requests.Timeout))
+
+
+class MegaplanClient:
+    """Асинхронный клиент Megaplan API.
+
+    Все запросы идут через одну requests.Session с общим пулом keep-alive соединений,
+    поэтому TLS-сессия открывается один раз на соединение пула, а не на каждый вызов.
+    Блокирующий ввод-вывод выполняется в собственном пуле потоков того же размера,
+    что и пул соединений, и не останавливает цикл событий.
+    Частота запросов ограничивается общим AdaptiveRateLimiter, а задачи, сотрудники
+    и комментарии кэшируются в EntityCache.
+    """
+
+    def __init__(self, base_url: str, api_key: str, pool_size: int = 10, timeout: int = 120,
+                 rate_limiter: Optional[AdaptiveRateLimiter] = None, max_retries: int = 3,
+                 task_cache: Optional[EntityCache] = None, employee_cache: Optional[EntityCache] = None,
+                 comment_cache: Optional[EntityCache] = None):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.rate_limiter = rate_limiter or AdaptiveRateLimiter(rate=5.0, burst=5)
+        self.max_retries = max_retries
+        self.task_cache = task_cache or EntityCache("task", ttl=120, maxsize=2048)
+        self.employee_cache = employee_cache or EntityCache("employee", ttl=3600, maxsize=2048)
+        self.comment_cache = comment_cache or EntityCache("comment", ttl=600, maxsize=2048)
+        self.session = requests.Session()
+        self.session.headers.update({"Authorization": f"Bearer {api_key}"})
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="megaplan")
+
+    async def _request(self, endpoint: str, method: str, path: str, **kwargs: Any) -> requests.Response:
+        """Выполняет запрос с ограничением частоты и повторами; endpoint — имя метода для метрик."""
+        loop = asyncio.get_running_loop()
+        call = functools.partial(self.session.request, method, f"{self.base_url}{path}",
+                                 timeout=self.timeout, **kwargs)
+        retry_statuses = RETRY_STATUSES if method == "GET" else RETRY_STATUSES_UNSAFE
+        for attempt in range(self.max_retries + 1):
+            await self.rate_limiter.acquire()
+            counter = api_call_counter.get()
+            started = time.perf_counter()
+            try:
+                response = await loop.run_in_executor(self._executor, call)
+            except requests.RequestException:
+                MEGAPLAN_REQUEST_ERRORS.labels(endpoint=endpoint, status="exception").inc()
+                raise
+            finally:
+                duration = time.perf_counter() - started
+                MEGAPLAN_REQUEST_DURATION.labels(endpoint=endpoint).observe(duration)
+                trace = export_trace.get()
+                if trace is not None:
+                    trace.calls.append((f"{endpoint} {path.split('?')[0]}", duration))
+            if not response.ok:
+                MEGAPLAN_REQUEST_ERRORS.labels(endpoint=endpoint, status=str(response.status_code)).inc()
+            if counter is not None:
+                counter["calls"] += 1
+                counter["bytes"] += len(response.content)
+            if response.status_code in retry_statuses and attempt < self.max_retries:
+                retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                logging.warning(f"Megaplan ответил {response.status_code} на {method} {path}, "
+                                f"повтор {attempt + 1}/{self.max_retries} (Retry-After: {retry_after})")
+                self.rate_limiter.backoff(retry_after)
+                # Потоковое тело перед повторной отправкой перематываем в начало
+                if hasattr(kwargs.get("data"), "seek"):
+                    kwargs["data"].seek(0)
+                continue
+            if response.ok:
+                self.rate_limiter.success()
+            response.raise_for_status()
+            return response
+
+    async def _get_data(self, endpoint: str, path: str, fields: Optional[Sequence] = None) -> Any:
+        """GET-запрос к API v3; fields ограничивает набор полей в ответе.
+
+        Параметры API v3 передаются JSON-объектом в строке запроса.
+        """
+        if fields:
+            path = f"{path}?{quote(json.dumps({'fields': list(fields)}, separators=(',', ':')))}"
+        response = await self._request(endpoint, "GET", path)
+        return response.json()["data"]
+
+    async def get_project_issues(self, project_id: str, fields: Optional[Sequence] = None) -> List[Dict]:
+        try:
+            project_data = await self._get_data("get_project_issues", f"/api/v3/project/{project_id}/issues",
+                                                fields)
+            logging.info(f"Получены задачи проекта с ID: {project_id}")
+            return project_data
+        except requests.exceptions.RequestException as e:
+            logging.exception(f"Error occurred while getting project {project_id}: {e}")
+            raise
+
+    async def get_project(self, project_id: str, fields: Optional[Sequence] = None) -> Dict:
+        try:
+            project_data = await self._get_data("get_project", f"/api/v3/project/{project_id}", fields)
+            logging.info(f"Получен проект с ID: {project_id}")
+            return project_data
+        except requests.exceptions.RequestException as e:
+            logging.exception(f"Error occurred while getting project {project_id}: {e}")
+            raise
+
+    async def _fetch_task(self, task_id: str, fields: Optional[Sequence] = None) -> Dict:
+        task_data = await self._get_data("get_task", f"/api/v3/task/{task_id}", fields)
+        entity_logger.info("Получена задача с ID: %s", task_id)
+        return task_data
+
+    async def get_task(self, task_id: str, fields: Optional[Sequence] = None, fresh: bool = False) -> Dict:
+        """Возвращает задачу из кэша; fresh=True принудительно перечитывает её из Megaplan.
+
+        Задачи с разным набором полей кэшируются отдельно.
+        """
+        key = (task_id, tuple(fields or ()))
+        if fresh:
+            self.task_cache.invalidate(key)
+        try:
+            return await self.task_cache.get_or_fetch(key, lambda: self._fetch_task(task_id, fields))
+        except requests.exceptions.RequestException as e:
+            logging.exception(f"Error occurred while getting task {task_id}: {e}")
+            raise
+
+    async def get_task_subtasks(self, task_id: str, fields: Optional[Sequence] = None) -> List[Dict]:
+        """Возвращает все подзадачи одним запросом вместо отдельного GET на каждую."""
+        try:
+            subtasks = await self._get_data("get_task_subtasks", f"/api/v3/task/{task_id}/subTasks", fields)
+            entity_logger.info("Получены подзадачи задачи с ID: %s", task_id)
+            return subtasks
+        except requests.exceptions.RequestException as e:
+            logging.exception(f"Error occurred while getting subtasks for task {task_id}: {e}")
+            raise
+
+    async def _fetch_comment(self, comment_id: str) -> str:
+        comment_data = await self._get_data("get_comment", f"/api/v3/comment/{comment_id}")
+        entity_logger.info("Получен комментарий с ID: %s", comment_id)
+        return comment_data["content"]
+
+    async def get_comment(self, comment_id: str) -> str:
+        """Возвращает содержимое комментария (HTML)."""
+        try:
+            return await self.comment_cache.get_or_fetch(comment_id, lambda: self._fetch_comment(comment_id))
+        except requests.exceptions.RequestException as e:
+            logging.exception(f"Error occurred while getting comment {comment_id}: {e}")
+            raise
+
+    async def _fetch_employee(self, employee_id: str) -> Dict:
+        employee_data = await self._get_data("get_employee", f"/api/v3/employee/{employee_id}")
+        entity_logger.info("Получен сотрудник с ID: %s", employee_id)
+        return employee_data
+
+    async def get_employee(self, employee_id: str) -> Dict:
+        try:
+            return await self.employee_cache.get_or_fetch(employee_id,
+                                                          lambda: self._fetch_employee(employee_id))
+        except requests.exceptions.RequestException as e:
+            logging.exception(f"Error occurred while getting employee {employee_id}: {e}")
+            raise
+
+    async def upload_file(self, file: BinaryIO, real_name: str,
+                          content_type: str = XLSX_CONTENT_TYPE) -> Optional[str]:
+        """Загружает файл в Megaplan и возвращает его ID или None при ошибке.
+
+        Файл читается с текущей позиции и отправляется потоково, без копирования в память.
+        """
+        body = MultipartFileStream('files[]', file, real_name, content_type)
+        try:
+            response = await self._request("upload_file", "POST", "/api/file", data=body,
+                                           headers={"Content-Type": body.content_type})
+            file_data = response.json()['data'][0]
+            return file_data['id']
+        except requests.RequestException as e:
+            logging.exception(f"Error uploading file: {e}")
+            return None
+
+    async def post_comment(self, entity_type: str, entity_id: str, body: Dict) -> None:
+        await self._request("post_comment", "POST", f"/api/v3/{entity_type}/{entity_id}/comments", json=body)
+
+    def cache_stats(self) -> Dict[str, Dict[str, int]]:
+        return {cache.name: cache.stats() for cache in (self.task_cache, self.employee_cache, self.comment_cache)}
+
+    def close(self) -> None:
+        self.session.close()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+megaplan_client = MegaplanClient(settings.MEGAPLAN_API_URL, settings.MEGAPLAN_API_KEY,
+                                 pool_size=settings.MEGAPLAN_POOL_SIZE, timeout=settings.MEGAPLAN_TIMEOUT,
+                                 rate_limiter=AdaptiveRateLimiter(rate=settings.MEGAPLAN_RATE_LIMIT,
+                                                                  burst=settings.MEGAPLAN_RATE_BURST),
+                                 max_retries=settings.MEGAPLAN_MAX_RETRIES,
+                                 task_cache=EntityCache("task", settings.CACHE_TASK_TTL, settings.CACHE_MAX_SIZE),
+                                 employee_cache=EntityCache("employee", settings.CACHE_EMPLOYEE_TTL,
+                                                            settings.CACHE_MAX_SIZE),
+                                 comment_cache=EntityCache("comment", settings.CACHE_COMMENT_TTL,
+                                                           settings.CACHE_MAX_SIZE))
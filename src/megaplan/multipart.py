@@ -0,0 +1,60 @@
+import os
+import uuid
+from typing import BinaryIO
+
+
+class MultipartFileStream:
+    """Тело multipart/form-data с одним файлом, читаемое потоково.
+
+    requests отправляет объекты с методом read() блоками и берёт Content-Length из __len__,
+    поэтому файл уходит в сокет напрямую, без сборки всего тела запроса в памяти.
+    """
+
+    def __init__(self, field_name: str, file: BinaryIO, filename: str, content_type: str):
+        self.boundary = uuid.uuid4().hex
+        # Экранирование имени файла как в urllib3 (WHATWG HTML)
+        filename = filename.translate({10: "%0A", 13: "%0D", 34: "%22"})
+        self._preamble = (
+            f'--{self.boundary}\r\n'
+            f'Content-Disposition: form-data; name="{field_name}"; filename="{filename}"\r\n'
+            f'Content-Type: {content_type}\r\n\r\n'
+        ).encode("utf-8")
+        self._epilogue = f'\r\n--{self.boundary}--\r\n'.encode("ascii")
+        self._file = file
+        self._file_start = file.tell()
+        self._file_size = file.seek(0, os.SEEK_END) - self._file_start
+        self.seek(0)
+
+    @property
+    def content_type(self) -> str:
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def __len__(self) -> int:
+        return len(self._preamble) + self._file_size + len(self._epilogue)
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> None:
+        """Перематывает тело в начало (нужно для повторной отправки)."""
+        if offset != 0 or whence != os.SEEK_SET:
+            raise ValueError("MultipartFileStream supports only rewinding to the start")
+        self._file.seek(self._file_start)
+        self._parts = [memoryview(self._preamble), self._file, memoryview(self._epilogue)]
+
+    def read(self, size: int = -1) -> bytes:
+        chunks = []
+        while self._parts and (size < 0 or size > 0):
+            part = self._parts[0]
+            if isinstance(part, memoryview):
+                chunk = bytes(part if size < 0 else part[:size])
+                rest = part[len(chunk):]
+                if rest:
+                    self._parts[0] = rest
+                else:
+                    self._parts.pop(0)
+            else:
+                chunk = part.read(size)
+                if not chunk or size < 0:
+                    self._parts.pop(0)
+            chunks.append(chunk)
+            if size > 0:
+                size -= len(chunk)
+        return b"".join(chunks)
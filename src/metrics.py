@@ -0,0 +1,115 @@
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from prometheus_client import Counter, Gauge, Histogram
+
+# Границы бакетов длительностей (секунды): выгрузки крупных брендов идут минутами
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+class ExportTrace:
+    """Трасса одной выгрузки: длительности этапов, задач линейки и запросов к Megaplan."""
+
+    def __init__(self, job_id: str):
+        self.job_id = job_id
+        self.stages: Dict[str, float] = defaultdict(float)
+        self.issues: List[Tuple[str, float]] = []
+        self.calls: List[Tuple[str, float]] = []
+        # Глубина критического пути: число последовательных волн запросов при обходе иерархии
+        self.depth = 0
+        # Длительность волн обхода по номеру (в сводной выгрузке — сумма по сущностям); волны идут
+        # внутри этапа fetch, поэтому в этапы и гистограмму не входят
+        self.waves: Dict[int, float] = defaultdict(float)
+
+    def observe_stages(self) -> None:
+        """Записывает этапы выгрузки в гистограмму: одно наблюдение на этап за выгрузку."""
+        for name, duration in self.stages.items():
+            EXPORT_STAGE_DURATION.labels(stage=name).observe(duration)
+
+    def summary(self, top: int = 5) -> str:
+        stages = ", ".join(f"{stage}={duration:.3f}s" for stage, duration in self.stages.items())
+        issues = ", ".join(f"{name} ({duration:.3f}s)"
+                           for name, duration in sorted(self.issues, key=lambda item: -item[1])[:top])
+        calls = ", ".join(f"{name} ({duration:.3f}s)"
+                          for name, duration in sorted(self.calls, key=lambda item: -item[1])[:top])
+        waves = ", ".join(f"{number}={duration:.3f}s" for number, duration in sorted(self.waves.items()))
+        return (f"Трасса выгрузки {self.job_id}: этапы: {stages}; глубина обхода: {self.depth} ({waves}); "
+                f"запросов: {len(self.calls)}, "
+                f"суммарно {sum(duration for _, duration in self.calls):.3f}s; "
+                f"самые долгие задачи: {issues}; самые долгие запросы: {calls}")
+
+
+export_trace: ContextVar[Optional[ExportTrace]] = ContextVar("export_trace", default=None)
+
+EXPORT_DURATION = Histogram("export_duration_seconds", "Total export duration", ["status"],
+                            buckets=DURATION_BUCKETS)
+EXPORT_STAGE_DURATION = Histogram("export_stage_duration_seconds", "Export stage duration", ["stage"],
+                                  buckets=DURATION_BUCKETS)
+EXPORT_ROWS = Counter("export_rows_written_total", "Rows written to export reports")
+EXPORT_WORKBOOK_BYTES = Histogram("export_workbook_bytes", "Size of rendered export files",
+                                  buckets=(10e3, 50e3, 100e3, 500e3, 1e6, 5e6, 10e6, 50e6))
+EXPORT_QUEUE_DEPTH = Gauge("export_queue_depth", "Exports waiting in the queue")
+EXPORTS_IN_FLIGHT = Gauge("export_in_flight", "Exports currently running")
+LOG_RECORDS_DROPPED = Counter("log_records_dropped_total", "Log records dropped because the log queue was full")
+RENDER_QUEUE_DEPTH = Gauge("export_render_queue_depth", "Reports waiting to be rendered")
+MEGAPLAN_REQUEST_DURATION = Histogram("megaplan_request_duration_seconds", "Megaplan API request latency",
+                                      ["endpoint"], buckets=DURATION_BUCKETS)
+MEGAPLAN_REQUEST_ERRORS = Counter("megaplan_request_errors_total", "Megaplan API errors by endpoint and status",
+                                  ["endpoint", "status"])
+
+
+@contextmanager
+def export_tracing(job_id: str) -> Iterator[ExportTrace]:
+    """Трасса выгрузки в текущем контексте; по завершении её этапы записываются в гистограмму."""
+    trace = ExportTrace(job_id)
+    token = export_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        export_trace.reset(token)
+        trace.observe_stages()
+
+
+# Время вложенных этапов внутри текущего; задачи asyncio наследуют его из контекста
+_nested_stages: ContextVar[Optional[List[float]]] = ContextVar("nested_stages", default=None)
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Замеряет этап выгрузки.
+
+    Время вложенных этапов (разбор описаний внутри загрузки) из внешнего этапа вычитается,
+    поэтому этапы не пересекаются. В трассе время этапа суммируется за выгрузку и попадает
+    в гистограмму одним наблюдением при её завершении; вне трассы этап наблюдается сразу.
+    """
+    outer = _nested_stages.get()
+    nested = [0.0]
+    token = _nested_stages.set(nested)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - started
+        _nested_stages.reset(token)
+        if outer is not None:
+            outer[0] += duration
+        trace = export_trace.get()
+        if trace is not None:
+            trace.stages[name] += duration - nested[0]
+        else:
+            EXPORT_STAGE_DURATION.labels(stage=name).observe(duration - nested[0])
+
+
+@contextmanager
+def wave_timer(number: int) -> Iterator[None]:
+    """Замеряет волну запросов обхода иерархии; записывается только в трассу."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace = export_trace.get()
+        if trace is not None:
+            trace.waves[number] += time.perf_counter() - started
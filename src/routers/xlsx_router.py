@@ -1,29 +1,58 @@
 import asyncio
-import html  # для декодирования HTML-кодов
 import logging
-import os
-import tempfile
 import time
+from urllib.parse import quote
 from datetime import datetime
-from typing import List, Dict
+from typing import Awaitable, Callable, List, Dict, NamedTuple, Optional, Sequence, Tuple
 
 import requests
-from fastapi import APIRouter, HTTPException
-from fastapi.responses import JSONResponse
-from openpyxl import Workbook
-from openpyxl.styles import PatternFill, Font, Alignment, Border, Side
+from fastapi import APIRouter, Header, HTTPException
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
 
 from config import settings
+from src.export.download import ReportCache, report_fingerprint, stream_report
+from src.export.hierarchy import HierarchyPlanner, NodeSpec, TaskTree
+from src.export.jobs import ExportScheduler
+from src.export.parsing import ProductParser, html_to_text
+from src.export.render import RenderPipeline, RenderRequest, SheetData
+from src.export.snapshot import ABSENT, SnapshotStore, modification_marker
+from src.export.writers import REPORT_WRITERS
+from src.export.xlsx_writer import ColumnWidthTracker
+from src.logging_setup import Lazy, entity_logger
+from src.megaplan.client import is_transient_error, megaplan_client
+from src.metrics import (EXPORT_QUEUE_DEPTH, EXPORT_ROWS, EXPORT_WORKBOOK_BYTES, EXPORTS_IN_FLIGHT,
+                         RENDER_QUEUE_DEPTH, export_trace, export_tracing, stage, wave_timer)
 
 router = APIRouter()
 
-MEGAPLAN_API_URL = settings.MEGAPLAN_API_URL
-MEGAPLAN_API_KEY = settings.MEGAPLAN_API_KEY
-MEGAPLAN_HEADER = {
-    "Authorization": f"Bearer {MEGAPLAN_API_KEY}",
-    "Content-Type": "application/json"
-}
+snapshot_store = (SnapshotStore(settings.SNAPSHOT_DB_PATH, settings.SNAPSHOT_MAX_AGE_DAYS)
+                  if settings.SNAPSHOT_DB_PATH else None)
+product_parser = ProductParser(settings.PRODUCT_PARSER_CACHE_SIZE)
+report_cache = (ReportCache(settings.REPORT_CACHE_DIR, settings.REPORT_CACHE_MAX_BYTES)
+                if settings.REPORT_CACHE_DIR else None)
+# Скачивания отчётов идут мимо очереди выгрузок, поэтому их загрузка и сборка ограничены отдельно
+download_slots = asyncio.Semaphore(settings.DOWNLOAD_CONCURRENCY)
+
+# Поля, которые запрашиваются у Megaplan на каждом уровне иерархии
+PROJECT_FIELDS = ["name", "responsible"]
+ISSUE_FIELDS = ["name", "subTasks", "actualStart", "responsible", "timeUpdated"]
+DEVELOPMENT_TASK_FIELDS = ["name", "subTasks", "responsible", "subject", "lastComment", "timeUpdated"]
+# При сверке со снимком задачу разработки читаем без тяжёлого описания: хватает полей версии,
+# а описание и ответственный догружаются только для задач, чьи версии изменились
+DEVELOPMENT_VERSION_FIELDS = ["name", "subTasks", "lastComment", "timeUpdated"]
+DEVELOPMENT_DETAIL_FIELDS = ["responsible", "subject"]
+SUPPLIER_TASK_FIELDS = ["name", "Category130CustomFieldStatus", "timeUpdated"]
+
+# Иерархия задачи линейки: задача разработки продуктов и её подзадачи поставщиков.
+# Поставщики загружаются одним запросом списка подзадач, как только известен ID задачи разработки
+ISSUE_HIERARCHY = NodeSpec("issue", tuple(ISSUE_FIELDS), children=(
+    NodeSpec("development", tuple(DEVELOPMENT_TASK_FIELDS), name_contains="разработка продуктов",
+             fresh_fields=tuple(DEVELOPMENT_VERSION_FIELDS), children=(
+        NodeSpec("raw_materials", tuple(SUPPLIER_TASK_FIELDS), name_equals="1. Поставщики сырья", batch=True),
+        NodeSpec("packaging", tuple(SUPPLIER_TASK_FIELDS), name_equals="2. Поставщики упаковки", batch=True),
+    )),
+))
 
 # Словарь с русскими названиями месяцев
 MONTHS_RU = {
@@ -42,223 +71,233 @@ MONTHS_RU = {
 }
 
 
-def get_project_issues(project_id: str, url: str, header: Dict[str, str]) -> List[Dict]:
-    url = f"{url}/api/v3/project/{project_id}/issues"
-    try:
-        response = requests.get(url, headers=header, timeout=120)
-        response.raise_for_status()
-        project_data = response.json()["data"]
-        logging.info(f"Получены задачи проекта с ID: {project_id}")
-        time.sleep(1)
-        return project_data
-    except requests.exceptions.RequestException as e:
-        logging.exception(f"Error occurred while getting project {project_id}: {e}")
-        raise
+async def get_responsible_name(responsible_data):
+    if "name" in responsible_data:
+        return responsible_data["name"]
+    else:
+        employee_id = responsible_data["id"]
+        employee_data = await megaplan_client.get_employee(employee_id)
+        return employee_data["name"]
 
 
-def get_project(project_id: str, url: str, header: Dict[str, str]) -> Dict:
-    url = f"{url}/api/v3/project/{project_id}"
-    try:
-        response = requests.get(url, headers=header, timeout=120)
-        response.raise_for_status()
-        project_data = response.json()["data"]
-        logging.info(f"Получен проект с ID: {project_id}")
-        time.sleep(1)
-        return project_data
-    except requests.exceptions.RequestException as e:
-        logging.exception(f"Error occurred while getting project {project_id}: {e}")
-        raise
+def extract_number(task):
+    # Извлекаем первое число из строки name
+    return int("".join(task["name"].split()[0].split(".")))
 
 
-def get_task(task_id: str, url: str, header: Dict[str, str]) -> Dict:
-    url = f"{url}/api/v3/task/{task_id}"
-    try:
-        response = requests.get(url, headers=header, timeout=120)
-        response.raise_for_status()
-        task_data = response.json()["data"]
-        logging.info(f"Получена задача с ID: {task_id}")
-        time.sleep(1)
-        return task_data
-    except requests.exceptions.RequestException as e:
-        logging.exception(f"Error occurred while getting task {task_id}: {e}")
-        raise
+async def get_custom_status(task: Optional[Dict]) -> str:
+    """Возвращает статус из Category130CustomFieldStatus подзадачи поставщиков."""
+    if not task:
+        return ""
+    entity_logger.info("Получена задача %s с ID %s", task["name"], task["id"])
+    if "Category130CustomFieldStatus" in task:
+        return task["Category130CustomFieldStatus"]
+    # Поле не пришло в списке подзадач, запрашиваем задачу отдельно
+    task_data = await megaplan_client.get_task(task["id"], fields=SUPPLIER_TASK_FIELDS)
+    return task_data.get("Category130CustomFieldStatus")
 
 
-def get_task_subtasks(task_id: str, url: str, header: Dict[str, str]) -> List[Dict]:
-    url = f"{url}/api/v3/task/{task_id}/subTasks"
-    try:
-        response = requests.get(url, headers=header, timeout=120)
-        response.raise_for_status()
-        subtasks = response.json()["data"]
-        logging.info(f"Получены подзадачи задачи с ID: {task_id}")
-        time.sleep(1)
-        return subtasks
-    except requests.exceptions.RequestException as e:
-        logging.exception(f"Error occurred while getting subtasks for task {task_id}: {e}")
-        raise
+async def get_development_details(task_data: Dict) -> Tuple[str, str]:
+    """Имя ответственного и HTML-описание задачи разработки.
 
+    При сверке со снимком эти поля не запрашивались, поэтому задача дочитывается минуя кэш.
+    """
+    if "subject" not in task_data or "responsible" not in task_data:
+        task_data = await megaplan_client.get_task(task_data["id"], fields=DEVELOPMENT_DETAIL_FIELDS, fresh=True)
+    return await get_responsible_name(task_data["responsible"]), task_data["subject"]
 
-def get_comment(comment_id: str, url: str, header: Dict[str, str]) -> str:
-    url = f"{url}/api/v3/comment/{comment_id}"
-    try:
-        response = requests.get(url, headers=header, timeout=120)
-        response.raise_for_status()
-        comment_data = response.json()["data"]
-        logging.info(f"Получен комментарий с ID: {comment_id}")
-        time.sleep(1)
-        clean_comment = clean_html(comment_data["content"])
-        return clean_comment
-    except requests.exceptions.RequestException as e:
-        logging.exception(f"Error occurred while getting comment {comment_id}: {e}")
-        return ""
 
+async def get_last_comment(task_data: Dict) -> Optional[str]:
+    """Текст последнего комментария; None — комментарий недоступен (ошибка Megaplan не временная).
 
-def get_employee(employee_id, url, header):
-    url = f"{url}/api/v3/employee/{employee_id}"
+    Временные ошибки пробрасываются, чтобы задачу загрузили повторно.
+    """
+    if not task_data["lastComment"]:
+        return ""
+    if "content" in task_data["lastComment"]:
+        return html_to_text(task_data["lastComment"]["content"])
     try:
-        response = requests.get(url, headers=header, timeout=120)
-        response.raise_for_status()
-        employee_data = response.json()["data"]
-        logging.info(f"Получен сотрудник с ID: {employee_id}")
-        time.sleep(1)
-        return employee_data
-    except requests.exceptions.RequestException as e:
-        logging.exception(f"Error occurred while getting employee {employee_id}: {e}")
-        raise
+        content = await megaplan_client.get_comment(task_data["lastComment"]["id"])
+    except requests.RequestException as e:
+        if is_transient_error(e):
+            raise
+        return None
+    return html_to_text(content)
 
 
-def get_responsible_name(responsible_data, url, header):
-    if "name" in responsible_data:
-        return responsible_data["name"]
-    else:
-        employee_id = responsible_data["id"]
-        employee_data = get_employee(employee_id, url, header)
-        return employee_data["name"]
-
-
-def is_product(text: str) -> bool:
-    return any(char.isdigit() for char in text)
-
+async def with_retries(fetch: Callable[[], Awaitable], description: str):
+    """Выполняет запрос с повторами при временных ошибках Megaplan и экспоненциальной задержкой."""
+    for attempt in range(settings.EXPORT_ISSUE_RETRIES + 1):
+        try:
+            return await fetch()
+        except Exception as e:
+            if not is_transient_error(e) or attempt == settings.EXPORT_ISSUE_RETRIES:
+                raise
+            delay = settings.EXPORT_ISSUE_RETRY_BACKOFF * 2 ** attempt
+            logging.warning(f"Временная ошибка при загрузке {description}: {e}. Повтор через {delay} с")
+            await asyncio.sleep(delay)
+
+
+async def load_task(task_id: str, fields: Sequence[str], fresh: bool) -> Dict:
+    return await with_retries(lambda: megaplan_client.get_task(task_id, fields=fields, fresh=fresh),
+                              f"задачи {task_id}")
+
+
+async def load_subtasks(task_id: str, fields: Sequence[str]) -> List[Dict]:
+    return await with_retries(lambda: megaplan_client.get_task_subtasks(task_id, fields=fields),
+                              f"подзадач задачи {task_id}")
+
+
+def issue_versions(tree: TaskTree, project_name: str, project_responsible: str) -> Dict[str, str]:
+    """Версии задачи линейки, задачи разработки и её подзадач для сверки со снимком."""
+    development_task_data = tree.nodes["development"]
+    return {
+        "context": f"{project_name}|{project_responsible}",
+        "issue": modification_marker(tree.nodes["issue"]),
+        "development": modification_marker(development_task_data),
+        "raw_materials": modification_marker(tree.nodes["raw_materials"]),
+        "packaging": modification_marker(tree.nodes["packaging"]),
+        "last_comment": (development_task_data["lastComment"] or {}).get("id", ABSENT),
+    }
 
-def clean_html(text: str) -> str:
-    """Удаление HTML-тегов и декодирование символов."""
-    text = html.unescape(text)  # Декодируем HTML-символы
-    text = text.replace('<br />', '\n').replace('</p>', '\n').replace('<p>', '').replace('</strong>', '').replace(
-        '<strong>', '')
-    return text.strip()
 
+async def build_issue_rows(tree: TaskTree, project_name: str, project_responsible: str) -> Tuple[List[tuple], bool]:
+    """Догружает ответственного и описание, статусы поставщиков и последний комментарий и возвращает строки
+    отчёта по задаче линейки без порядкового номера и признак, что строки полные и годятся для снимка."""
+    issue_data = tree.nodes["issue"]
+    development_task_data = tree.nodes["development"]
+
+    # Независимые запросы по задаче разработки выполняем одновременно
+    (owner_name, subject), raw_materials_comment, packaging_comment, last_comment = await asyncio.gather(
+        get_development_details(development_task_data),
+        get_custom_status(tree.nodes["raw_materials"]),
+        get_custom_status(tree.nodes["packaging"]),
+        get_last_comment(development_task_data),
+    )
+    # Строки без текста комментария неполные: в снимок их не сохраняем, чтобы при следующей выгрузке перечитать его
+    complete = last_comment is not None
+    last_comment = last_comment or ""
+
+    with stage("parse"):
+        # Разбор списка продуктов из HTML-описания задачи разработки
+        products = product_parser.parse(subject)
+        entity_logger.info("Продукты: %s", products)
+        entity_logger.info("Комментарии:\nraw_materials_comment=%r\npackaging_comment=%r\nlast_comment=%r",
+                           raw_materials_comment, packaging_comment, last_comment)
+
+        # Форматируем дату
+        raw_date = issue_data["actualStart"]["value"]
+        date_obj = datetime.strptime(raw_date, "%Y-%m-%dT%H:%M:%S%z")
+        formatted_date = f"{date_obj.day} {MONTHS_RU[date_obj.month]}"
+
+        rows = [
+            (project_name, issue_data["name"], product, formatted_date, project_responsible, owner_name,
+             raw_materials_comment, packaging_comment, last_comment)
+            for product in products
+        ]
+    return rows, complete
+
+
+async def process_tasks(project_name: str, issues: List[Dict], project_responsible,
+                        width_tracker: ColumnWidthTracker) -> Tuple[List[tuple], List[tuple]]:
+    """Загружает строки отчёта по всем задачам линейки в порядке extract_number.
+
+    Иерархия задач (ISSUE_HIERARCHY) обходится в ширину: каждый уровень всех задач линейки загружается
+    одной волной, затем последней волной догружаются ответственные, статусы и комментарии — кроме задач,
+    чьи версии совпали со снимком.
+
+    Возвращает строки и список ошибок (бренд, линейка, описание) по задачам с нарушенной структурой:
+    такие задачи пропускаются, не прерывая выгрузку. При временной ошибке Megaplan остальные задачи
+    догружаются, собранные сохраняются в снимок, и только затем ошибка пробрасывается: повторная выгрузка
+    возьмёт эти задачи из снимка.
+    """
+    entity_logger.info("Задачи линейки:\n%s", Lazy(lambda: "\n".join(issue["name"] for issue in issues)))
+    issues_rows: Dict[str, List[tuple]] = {}
+    errors: Dict[str, tuple] = {}
+    transient_errors: List[Exception] = []
+    snapshot_entries: List[Tuple[str, Dict[str, str], List[tuple]]] = []
+    trace = export_trace.get()
+
+    def issue_failed(issue: Dict, error: Exception) -> None:
+        if is_transient_error(error):
+            transient_errors.append(error)
+            return
+        # Ошибка структуры данных в одной задаче не прерывает всю выгрузку
+        logging.error(f"Ошибка структуры данных в задаче {issue['name']}: {error}", exc_info=error)
+        errors[issue["id"]] = (project_name, issue["name"], f"{type(error).__name__}: {error}")
+
+    snapshots = await snapshot_store.get_many([issue["id"] for issue in issues]) if snapshot_store else {}
+    planner = HierarchyPlanner(ISSUE_HIERARCHY, load_task, load_subtasks,
+                               concurrency=settings.EXPORT_ISSUE_CONCURRENCY)
+    # При наличии снимка версии сверяем по свежим данным, минуя кэш. Проверка стоит два запроса на задачу
+    # (задача разработки без описания и список поставщиков): timeUpdated задачи линейки в списке задач проекта
+    # не меняется при изменении подзадач. Для изменившихся задач описание дочитывается отдельным запросом
+    trees = await planner.run(issues, loaded=lambda issue: "subTasks" in issue and "actualStart" in issue,
+                              fresh=lambda issue: snapshots.get(issue["id"]) is not None)
+
+    to_build = []
+    for tree in trees:
+        issue = tree.root
+        if tree.error is not None:
+            issue_failed(issue, tree.error)
+            continue
+        if tree.nodes["development"] is None:
+            issues_rows[issue["id"]] = []
+            continue
+        try:
+            versions = issue_versions(tree, project_name, project_responsible)
+        except Exception as e:
+            issue_failed(issue, e)
+            continue
+        snapshot = snapshots.get(issue["id"])
+        if snapshot is not None and snapshot.matches(versions):
+            entity_logger.info("Задача %s не изменилась, строки взяты из снимка", issue["name"])
+            issues_rows[issue["id"]] = snapshot.rows
+            if trace is not None:
+                trace.issues.append((issue["name"], tree.elapsed))
+        else:
+            to_build.append((tree, versions))
+
+    depth = planner.depth
+    if to_build:
+        depth += 1
+        semaphore = asyncio.Semaphore(settings.EXPORT_ISSUE_CONCURRENCY)
+
+        async def build_limited(tree: TaskTree, versions: Dict[str, str]) -> None:
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    rows, complete = await with_retries(
+                        lambda: build_issue_rows(tree, project_name, project_responsible),
+                        f"задачи {tree.root['name']}")
+                except Exception as e:
+                    issue_failed(tree.root, e)
+                    return
+                issues_rows[tree.root["id"]] = rows
+                if complete:
+                    snapshot_entries.append((tree.root["id"], versions, rows))
+                if trace is not None:
+                    trace.issues.append((tree.root["name"], tree.elapsed + time.perf_counter() - started))
 
-def extract_number(task):
-    # Извлекаем первое число из строки name
-    return int("".join(task["name"].split()[0].split(".")))
+        try:
+            with wave_timer(depth):
+                await asyncio.gather(*(build_limited(tree, versions) for tree, versions in to_build))
+        finally:
+            if snapshot_store:
+                await snapshot_store.save_many(snapshot_entries)
 
+    logging.info(f"Линейка {project_name}: задач {len(issues)}, глубина обхода {depth} волн(ы)")
+    if trace is not None:
+        trace.depth = max(trace.depth, depth)
+    if transient_errors:
+        raise transient_errors[0]
 
-def process_tasks(project_name: str, issues: List[Dict], sheet, project_responsible) -> None:
-    row = 2
-    logging.info(f"Задачи линейки:\n{"\n".join(issue["name"] for issue in issues)}")
+    rows = []
     for issue in issues:
-        issue_name = issue["name"]
-        issue_data = get_task(issue["id"], MEGAPLAN_API_URL, MEGAPLAN_HEADER)
-
-        development_task = next(
-            (task for task in issue_data["subTasks"] if "разработка продуктов" in task["name"].lower()), None)
-        if development_task:
-            logging.info(f'Получена задача {development_task["name"]} с ID {development_task["id"]}')
-            development_task_data = get_task(development_task["id"], MEGAPLAN_API_URL, MEGAPLAN_HEADER)
-            owner_name = get_responsible_name(development_task_data["responsible"], MEGAPLAN_API_URL, MEGAPLAN_HEADER)
-
-            # Получение комментариев и имени ответственного перед циклом
-            raw_materials_comment = ""
-            packaging_comment = ""
-            last_comment = ""
-
-            raw_materials_task = next(
-                (task for task in development_task_data["subTasks"] if task["name"] == "1. Поставщики сырья"), None)
-
-            if raw_materials_task:
-                logging.info(f'Получена задача 1. Поставщики сырья с ID {raw_materials_task["id"]}')
-                raw_materials_task_data = get_task(raw_materials_task["id"], MEGAPLAN_API_URL, MEGAPLAN_HEADER)
-                raw_materials_comment = raw_materials_task_data.get("Category130CustomFieldStatus")
-
-            packaging_task = next(
-                (task for task in development_task_data["subTasks"] if task["name"] == "2. Поставщики упаковки"), None)
-            if packaging_task:
-                logging.info(f'Получена задача 2. Поставщики упаковки с ID {packaging_task["id"]}')
-                packaging_task_data = get_task(packaging_task["id"], MEGAPLAN_API_URL, MEGAPLAN_HEADER)
-                packaging_comment = packaging_task_data.get("Category130CustomFieldStatus")
-
-            if development_task_data["lastComment"]:
-                last_comment = get_comment(development_task_data["lastComment"]["id"], MEGAPLAN_API_URL,
-                                           MEGAPLAN_HEADER)
-
-            # Декодирование и очистка данных
-            products_raw = development_task_data["subject"]
-            products_clean = clean_html(products_raw)
-            logging.info(f"Продукты: {products_clean}")
-            logging.info(f"Комментарии:\n{raw_materials_comment=}\n{packaging_comment=}\n{last_comment=}\n")
-
-            products = products_clean.split("\n\n")  # Разделение продуктов
-            if len(products) == 1:
-                if all(el[0].isdigit() for el in products_clean.split("\n") if el):
-                    products = products_clean.split("\n")
-
-            # Форматируем дату
-            raw_date = issue_data["actualStart"]["value"]
-            date_obj = datetime.strptime(raw_date, "%Y-%m-%dT%H:%M:%S%z")
-            formatted_date = f"{date_obj.day} {MONTHS_RU[date_obj.month]}"
-
-            for product in products:
-                if is_product(product):
-                    sheet.cell(row=row, column=1, value=row - 1).alignment = Alignment(horizontal="center",
-                                                                                       vertical="center")
-                    sheet.cell(row=row, column=2, value=project_name).alignment = Alignment(horizontal="center",
-                                                                                            vertical="center")
-                    sheet.cell(row=row, column=3, value=issue_name).alignment = Alignment(horizontal="center",
-                                                                                          vertical="center")
-
-                    sheet.cell(row=row, column=4, value=product).alignment = Alignment(wrap_text=True,
-                                                                                       horizontal="left",
-                                                                                       vertical="center")
-
-                    sheet.cell(row=row, column=5, value=formatted_date).alignment = Alignment(horizontal="center",
-                                                                                              vertical="center")
-
-                    sheet.cell(row=row, column=6, value=project_responsible).alignment = Alignment(horizontal="center",
-                                                                                                   vertical="center")
-                    sheet.cell(row=row, column=7, value=owner_name).alignment = Alignment(
-                        horizontal="center", vertical="center")
-
-                    sheet.cell(row=row, column=8, value=raw_materials_comment).alignment = Alignment(
-                        horizontal="center",
-                        vertical="center")
-                    sheet.cell(row=row, column=9, value=packaging_comment).alignment = Alignment(horizontal="center",
-                                                                                                 vertical="center")
-                    sheet.cell(row=row, column=10, value=last_comment).alignment = Alignment(horizontal="center",
-                                                                                             vertical="center")
-
-                    row += 1
-
-
-def upload_file(filename, real_name):
-    url = f"{MEGAPLAN_API_URL}/api/file"
-    headers = {
-        "Authorization": f"Bearer {MEGAPLAN_API_KEY}"
-
-    }
-    real_name = real_name = f"{real_name}.{filename.rsplit('.', 1)[-1]}"
-    with open(filename, 'rb') as file:
-        files = {'files[]': (real_name, file, 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')}
-        try:
-            response = requests.post(url, headers=headers, files=files)
-            response.raise_for_status()
-            file_data = response.json()['data'][0]
-            file_id = file_data['id']
-            return file_id
-        except requests.RequestException as e:
-            logging.exception(f"Error uploading file: {e}")
-            return None
-        finally:
-            os.remove(filename)
+        issue_rows = issues_rows.get(issue["id"], [])
+        width_tracker.update_many(issue_rows)
+        rows.extend(issue_rows)
+    return rows, [errors[issue["id"]] for issue in issues if issue["id"] in errors]
 
 
 @router.get("/app/test")
@@ -269,6 +308,16 @@ async def test_endpoint():
 class EntityRequest(BaseModel):
     entityType: str
     entityId: str
+    # Формат файла: xlsx, csv, ndjson или parquet (если установлен pyarrow)
+    format: str = "xlsx"
+
+
+def validate_output_format(output_format: str) -> str:
+    output_format = output_format.lower()
+    if output_format not in REPORT_WRITERS:
+        raise HTTPException(status_code=400,
+                            detail=f"Invalid format. Must be one of: {', '.join(REPORT_WRITERS)}.")
+    return output_format
 
 
 @router.post("/app/unloading-tasks")
@@ -279,22 +328,151 @@ async def unload_tasks(request: EntityRequest):
 
     if entity_type not in ["project", "task"]:
         raise HTTPException(status_code=400, detail="Invalid entityType. Must be 'project' or 'task'.")
+    output_format = validate_output_format(request.format)
+
+    # Ставим выгрузку в очередь; повторные вебхуки на ту же сущность объединяются
+    job = export_scheduler.submit(entity_type, entity_id, output_format=output_format)
+    return JSONResponse(status_code=200, content={"message": "Задача выгрузки принята в обработку",
+                                                  "jobId": job.id})
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    # Слабые валидаторы (W/"...") сравниваются как сильные: отпечаток строится по данным, а не по байтам файла
+    tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    return "*" in tags or etag in tags
+
 
-    # Создаем асинхронную задачу для обработки выгрузки
-    asyncio.create_task(process_tasks_unloading(entity_type, entity_id))
-    return JSONResponse(status_code=200, content={"message": "Задача выгрузки принята в обработку"})
+@router.get("/app/unloading-tasks/{entity_type}/{entity_id}")
+async def download_tasks(entity_type: str, entity_id: str, format: str = "xlsx",
+                         if_none_match: Optional[str] = Header(None)):
+    """Отдаёт отчёт сразу в ответе, без комментария в Megaplan.
+
+    ETag — отпечаток загруженных данных: если данные не изменились, клиент получает 304,
+    а повторный запрос без If-None-Match отдаётся из кэша собранных файлов без повторной сборки.
+    """
+    entity_type = entity_type.lower()
+    if entity_type not in ["project", "task"]:
+        raise HTTPException(status_code=400, detail="Invalid entityType. Must be 'project' or 'task'.")
+    output_format = validate_output_format(format)
+
+    # Места освобождаются между загрузкой и сборкой: сборка занимает место уже в потоке ответа
+    async with download_slots:
+        # Трасса нужна, чтобы этапы скачивания попали в гистограмму так же, как этапы выгрузок из очереди
+        with export_tracing(f"download:{entity_type}:{entity_id}"), stage("fetch"):
+            try:
+                entity = await fetch_entity_rows(entity_type, entity_id)
+            except requests.RequestException as e:
+                # Неизвестная сущность — ошибка клиента, остальные сбои Megaplan — ошибка шлюза
+                response = getattr(e, "response", None)
+                if response is not None and response.status_code == 404:
+                    raise HTTPException(status_code=404, detail=f"{entity_type} {entity_id} not found")
+                logging.error(f"Ошибка загрузки {entity_type} {entity_id} из Megaplan: {e}")
+                raise HTTPException(status_code=502, detail="Megaplan request failed")
+    request = RenderRequest(output_format=output_format,
+                            sheets=[SheetData("Задачи", entity.width_tracker.widths(), entity.rows)],
+                            errors=entity.errors)
+    fingerprint = report_fingerprint(request)
+    headers = {"ETag": f'"{fingerprint}"', "Cache-Control": "private, no-cache"}
+    if etag_matches(if_none_match, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+
+    writer_class = REPORT_WRITERS[output_format]
+    filename = f"{entity.project_name}.{writer_class.extension}"
+    headers["Content-Disposition"] = f"attachment; filename*=UTF-8''{quote(filename)}"
+    cached = report_cache.get(fingerprint, writer_class.extension) if report_cache else None
+    if cached:
+        logging.info(f"Отчёт {filename} отдан из кэша ({fingerprint})")
+        return FileResponse(cached, media_type=writer_class.content_type, headers=headers)
+    return StreamingResponse(stream_report(render_pipeline, request, fingerprint, report_cache, download_slots),
+                             media_type=writer_class.content_type, headers=headers)
+
+
+class BulkEntityRequest(BaseModel):
+    entities: List[EntityRequest]
+    # Сущность, к которой прикрепляется итоговый файл; по умолчанию первая из списка
+    target: Optional[EntityRequest] = None
+    format: str = "xlsx"
+
+
+@router.post("/app/unloading-tasks/bulk")
+async def unload_tasks_bulk(request: BulkEntityRequest):
+    logging.info(f"Bulk_data: {request.json()}")
+    if not request.entities:
+        raise HTTPException(status_code=400, detail="No entities to export.")
+    sources = tuple((entity.entityType.lower(), entity.entityId) for entity in request.entities)
+    target = request.target or request.entities[0]
+    target_type = target.entityType.lower()
+    if any(entity_type not in ["project", "task"] for entity_type, _ in sources) or \
+            target_type not in ["project", "task"]:
+        raise HTTPException(status_code=400, detail="Invalid entityType. Must be 'project' or 'task'.")
+    output_format = validate_output_format(request.format)
 
+    job = export_scheduler.submit(target_type, target.entityId, sources=sources, output_format=output_format)
+    return JSONResponse(status_code=200, content={"message": "Задача выгрузки принята в обработку",
+                                                  "jobId": job.id})
 
-async def process_tasks_unloading(entity_type: str, entity_id: str):
+
+@router.get("/app/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = export_scheduler.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return JSONResponse(status_code=200, content=job.to_dict())
+
+
+class EntityRows(NamedTuple):
+    """Строки отчёта по одному проекту или задаче."""
+    project_name: str
+    project_responsible: str
+    issues_count: int
+    rows: List[tuple]
+    width_tracker: ColumnWidthTracker
+    errors: List[tuple]
+
+
+async def fetch_entity_rows(entity_type: str, entity_id: str) -> EntityRows:
+    # Получение данных в зависимости от типа сущности
+    if entity_type == "project":
+        issues = await megaplan_client.get_project_issues(entity_id, fields=ISSUE_FIELDS)
+        issues = sorted(issues, key=extract_number)
+        project_data = await megaplan_client.get_project(entity_id, fields=PROJECT_FIELDS)
+        project_name = project_data["name"]
+        project_responsible = await get_responsible_name(project_data["responsible"])
+    elif entity_type == "task":
+        task_data = await megaplan_client.get_task(entity_id, fields=PROJECT_FIELDS)
+        issues = await megaplan_client.get_task_subtasks(entity_id, fields=ISSUE_FIELDS)
+        issues = sorted(issues, key=extract_number)
+        project_name = task_data["name"]
+        project_responsible = await get_responsible_name(task_data["responsible"])
+    else:
+        # Эта проверка уже сделана, но оставляем её для дополнительной безопасности
+        raise HTTPException(status_code=400, detail="Unsupported entityType")
+
+    # Запуск обработки задач
+    width_tracker = ColumnWidthTracker()
+    rows, errors = await process_tasks(project_name, issues, project_responsible, width_tracker)
+    return EntityRows(project_name, project_responsible, len(issues), rows, width_tracker, errors)
+
+
+async def process_tasks_unloading(entity_type: str, entity_id: str,
+                                  sources: Optional[Sequence[Tuple[str, str]]] = None,
+                                  output_format: str = "xlsx"):
+    """Выгружает задачи в файл и прикрепляет его комментарием к сущности entity_type/entity_id.
+
+    sources — список (entityType, entityId) для сводной выгрузки: каждая сущность попадает на
+    отдельный лист, плюс сводный лист. По умолчанию выгружается сама сущность.
+    output_format — ключ REPORT_WRITERS; плоские форматы пишут все строки одним потоком,
+    задачи с ошибками — в конце, с описанием в столбце «Ошибка».
+    """
     # Определяем URL для комментария и структуру subject в зависимости от типа сущности
     if entity_type == "project":
-        comment_url = f"{MEGAPLAN_API_URL}/api/v3/project/{entity_id}/comments"
         subject = {
             "id": entity_id,
             "contentType": "Project"
         }
     elif entity_type == "task":
-        comment_url = f"{MEGAPLAN_API_URL}/api/v3/task/{entity_id}/comments"
         subject = {
             "id": entity_id,
             "contentType": "Task"
@@ -303,87 +481,53 @@ async def process_tasks_unloading(entity_type: str, entity_id: str):
         # Эта проверка уже сделана в маршруте, но оставляем её для дополнительной безопасности
         raise HTTPException(status_code=400, detail="Unsupported entityType")
 
+    bulk = bool(sources)
+    sources = sources or [(entity_type, entity_id)]
+
     try:
-        # Создаем временный файл Excel
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".xlsx") as tmp:
-            workbook = Workbook()
-            sheet = workbook.active
-            sheet.title = "Задачи"
-
-            # Настройка стилей для первой строки
-            header_fill = PatternFill(start_color="FFEB84", end_color="FFEB84", fill_type="solid")  # Жёлтый цвет
-            header_font = Font(bold=True)
-            header_alignment = Alignment(horizontal='center', vertical='center', wrap_text=True)
-
-            # Границы для разграничения заголовков
-            thin_border = Border(left=Side(style='thin'),
-                                 right=Side(style='thin'),
-                                 top=Side(style='thin'),
-                                 bottom=Side(style='thin'))
-
-            # Установка заголовков и применение стиля ко всей первой строке
-            headers = ["№", "Бренд", "Линейка", "Наименование", "Дата запуска работы", "Ответственный БМ",
-                       "Ответственный ОЗ", "Сырье", "Упаковка", "Примечание"]
-            for col_num, header in enumerate(headers, 1):
-                cell = sheet.cell(row=1, column=col_num, value=header)
-                cell.fill = header_fill  # Применяем жёлтый цвет
-                cell.font = header_font
-                cell.alignment = header_alignment
-                cell.border = thin_border  # Добавляем границы
-
-            # Получение данных в зависимости от типа сущности
-            if entity_type == "project":
-                issues = get_project_issues(entity_id, MEGAPLAN_API_URL, MEGAPLAN_HEADER)
-                issues = sorted(issues, key=extract_number)
-                project_data = get_project(entity_id, MEGAPLAN_API_URL, MEGAPLAN_HEADER)
-                project_name = project_data["name"]
-                project_responsible = get_responsible_name(project_data["responsible"], MEGAPLAN_API_URL,
-                                                           MEGAPLAN_HEADER)
-            elif entity_type == "task":
-                task_data = get_task(entity_id, MEGAPLAN_API_URL, MEGAPLAN_HEADER)
-                issues = get_task_subtasks(entity_id, MEGAPLAN_API_URL, MEGAPLAN_HEADER)
-                issues = sorted(issues, key=extract_number)
-                project_name = task_data["name"]
-                project_responsible = get_responsible_name(task_data["responsible"], MEGAPLAN_API_URL,
-                                                           MEGAPLAN_HEADER)
-            else:
-                # Эта проверка уже сделана, но оставляем её для дополнительной безопасности
-                raise HTTPException(status_code=400, detail="Unsupported entityType")
-
-            # Запуск обработки задач
-            process_tasks(project_name, issues, sheet, project_responsible)
-
-            # Настройка ширины колонок
-            for column_cells in sheet.columns:
-                length = max(len(str(cell.value)) for cell in column_cells) + 2  # Добавляем дополнительную ширину
-                sheet.column_dimensions[column_cells[0].column_letter].width = min(length,
-                                                                                   50)  # Ограничение максимальной шириной
-
-            sheet.column_dimensions['A'].width = 5
-            sheet.column_dimensions['D'].width = 50
-
-            # Ограничение ширины столбцов сырье/упаковка/примечание
-            max_width = 50  # Максимальная ширина в символах
-            sheet.column_dimensions['H'].width = max_width  # Столбец "Сырье"
-            sheet.column_dimensions['I'].width = max_width  # Столбец "Упаковка"
-            sheet.column_dimensions['J'].width = max_width  # Столбец "Примечание"
-
-            # Перенос текста для столбцов 'H', 'I', 'J'
-            for column_letter in ['H', 'I', 'J']:
-                for cell in sheet[column_letter]:
-                    cell.alignment = Alignment(wrap_text=True, vertical='top')
-
-            workbook.save(tmp.name)
-            tmp.close()
-
-        # Загружаем файл
-        file_id = upload_file(tmp.name, real_name=project_name)
+        with stage("fetch"):
+            # Сущности загружаются параллельно; общие задачи и сотрудники берутся из кэша
+            entities = await asyncio.gather(*(fetch_entity_rows(source_type, source_id)
+                                              for source_type, source_id in sources))
+
+        # Сборка файла идёт вне цикла событий, пока воркеры планировщика загружают следующие выгрузки
+        errors = [error for entity in entities for error in entity.errors]
+        request = RenderRequest(
+            output_format=output_format,
+            sheets=[SheetData(entity.project_name if bulk else "Задачи", entity.width_tracker.widths(), entity.rows)
+                    for entity in entities],
+            summary=[(entity.project_name, entity.project_responsible, entity.issues_count, len(entity.rows))
+                     for entity in entities] if bulk else None,
+            errors=errors,
+        )
+        with stage("render"):
+            report = await render_pipeline.render(request)
+
+        with report.file:
+            EXPORT_ROWS.inc(report.rows_written)
+            EXPORT_WORKBOOK_BYTES.observe(report.size)
+            logging.info(f"Размер отчёта: {report.size} байт")
+
+            project_name = entities[0].project_name
+            if bulk:
+                project_name = f"Сводная выгрузка {datetime.now():%d.%m.%Y}"
+
+            # Загружаем файл прямо из буфера
+            with stage("upload"):
+                file_id = await megaplan_client.upload_file(report.file,
+                                                            real_name=f"{project_name}.{report.extension}",
+                                                            content_type=report.content_type)
 
         if not file_id:
             raise HTTPException(status_code=500, detail="Error uploading file")
 
         # Отправляем комментарий с файлом
         content_text = f"Задачи проекта {project_name}"
+        if bulk:
+            content_text = f"Задачи проектов {', '.join(entity.project_name for entity in entities)}"
+        if errors:
+            content_text += (f". Не выгружено задач с ошибками структуры: {len(errors)}, "
+                             f"{REPORT_WRITERS[output_format].errors_hint}")
         body = {
             "contentType": "CommentCreateActionRequest",
             "comment": {
@@ -403,10 +547,11 @@ async def process_tasks_unloading(entity_type: str, entity_id: str):
         }
 
         try:
-            response = requests.post(comment_url, headers=MEGAPLAN_HEADER, json=body)
-            response.raise_for_status()
+            with stage("comment"):
+                await megaplan_client.post_comment(entity_type, entity_id, body)
             logging.info(
                 f"Комментарий успешно отправлен для {'проекта' if entity_type == 'project' else 'задачи'} с ID: {entity_id}")
+            logging.info(f"Статистика кэша Megaplan: {megaplan_client.cache_stats()}")
         except requests.RequestException as e:
             logging.exception(f"Error posting comment: {e}")
             raise HTTPException(status_code=500, detail="Error posting comment")
@@ -415,6 +560,9 @@ async def process_tasks_unloading(entity_type: str, entity_id: str):
         logging.exception(f"Error during process_tasks_unloading: {e}")
         # Отправляем комментарий с сообщением об ошибке
         error_content = "[KUBIT — Отчет] Ошибка структуры данных. Проверьте соблюдение иерархии"
+        if is_transient_error(e):
+            error_content = ("[KUBIT — Отчет] Megaplan временно недоступен. "
+                             "Запустите выгрузку повторно: она продолжится с места остановки")
         error_body = {
             "contentType": "CommentCreateActionRequest",
             "comment": {
@@ -428,9 +576,21 @@ async def process_tasks_unloading(entity_type: str, entity_id: str):
             ]
         }
         try:
-            error_response = requests.post(comment_url, headers=MEGAPLAN_HEADER, json=error_body)
-            error_response.raise_for_status()
+            await megaplan_client.post_comment(entity_type, entity_id, error_body)
             logging.info(
                 f"Комментарий об ошибке успешно отправлен для {'проекта' if entity_type == 'project' else 'задачи'} с ID: {entity_id}")
         except requests.RequestException as ex:
             logging.exception(f"Error sending error comment: {ex}")
+        # Пробрасываем исключение, чтобы планировщик отметил задачу как неуспешную
+        raise
+
+
+render_pipeline = RenderPipeline(processes=settings.RENDER_PROCESSES, threads=settings.RENDER_THREADS,
+                                 queue_size=settings.RENDER_QUEUE_SIZE,
+                                 process_min_rows=settings.RENDER_PROCESS_MIN_ROWS,
+                                 spool_max_size=settings.EXPORT_SPOOL_MAX_SIZE)
+export_scheduler = ExportScheduler(process_tasks_unloading, workers=settings.EXPORT_WORKERS,
+                                   history_size=settings.EXPORT_JOB_HISTORY, trace_log=settings.EXPORT_TRACE_LOG)
+EXPORT_QUEUE_DEPTH.set_function(lambda: export_scheduler.queue_depth)
+EXPORTS_IN_FLIGHT.set_function(lambda: export_scheduler.running)
+RENDER_QUEUE_DEPTH.set_function(lambda: render_pipeline.queue_depth)
@@ -0,0 +1,60 @@
+import pytest
+
+from src.export.parsing import ProductParser, html_to_text, split_products
+
+
+# Описания задач разработки в том виде, в каком их отдаёт Megaplan, и ожидаемый список продуктов
+@pytest.mark.parametrize("subject, expected", [
+    # Один продукт на абзац
+    ("<p>1. Крем для рук 50 мл</p><p>2. Бальзам для губ 10 мл</p>",
+     ("1. Крем для рук 50 мл", "2. Бальзам для губ 10 мл")),
+    # Многострочные продукты разделены пустой строкой, заголовок без цифр отбрасывается
+    ("<p><strong>Продукты:</strong></p><br /><p>1. Шампунь 250 мл<br />арт. 1</p><br />"
+     "<p>2. Маска 200 мл<br />арт. 2</p><br />",
+     ("1. Шампунь 250 мл\nарт. 1", "2. Маска 200 мл\nарт. 2")),
+    # Сущности, кавычки-ёлочки и неразрывный пробел
+    ("<p>1. Сыворотка &laquo;Сияние&raquo;&nbsp;30&nbsp;мл</p><p>2. Тоник &amp; лосьон 150 мл</p>",
+     ("1. Сыворотка «Сияние»\xa030\xa0мл", "2. Тоник & лосьон 150 мл")),
+    # Варианты <br> и произвольные теги форматирования
+    ("<p>1. <em>Гель</em> для душа 400 мл<br>2. <span style=\"color: red\">Пенка</span> 150 мл<BR/>"
+     "3. Скраб 200 мл</p>",
+     ("1. Гель для душа 400 мл", "2. Пенка 150 мл", "3. Скраб 200 мл")),
+    # Маркированный и нумерованный списки
+    ("<ul><li>Крем 50 мл</li><li>Лосьон 100 мл</li></ul>", ("Крем 50 мл\nЛосьон 100 мл",)),
+    ("<ol><li>1. Крем 50 мл</li><li>2. Лосьон 100 мл</li></ol>", ("1. Крем 50 мл", "2. Лосьон 100 мл")),
+    # Экранированные угловые скобки остаются текстом, а не тегами
+    ("<p>1. Масло &lt;base&gt; 100 мл</p>", ("1. Масло <base> 100 мл",)),
+    # Лишние пустые строки между продуктами
+    ("<p>1. Крем 50 мл</p><br /><br /><br /><p>Лосьон 100 мл</p>", ("1. Крем 50 мл", "Лосьон 100 мл")),
+    # Пустое описание и описание без продуктов
+    ("", ()),
+    ("<p>Продукты уточняются</p>", ()),
+])
+def test_parse_products(subject, expected):
+    assert ProductParser().parse(subject) == expected
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("<p>Согласовано, отправил <strong>поставщику</strong></p>", "Согласовано, отправил поставщику"),
+    ("<p>Ждём образцы<br />до пятницы</p><p></p>", "Ждём образцы\nдо пятницы"),
+    ("Цена &gt; 100 руб.<!-- черновик -->", "Цена > 100 руб."),
+    ("<!-- <p>черновик</p> -->Готово", "Готово"),
+])
+def test_html_to_text(text, expected):
+    assert html_to_text(text) == expected
+
+
+def test_split_products_by_lines_only_when_every_line_is_numbered():
+    assert split_products("1. Крем\n2. Лосьон") == ("1. Крем", "2. Лосьон")
+    assert split_products("1. Крем\nарт. 5") == ("1. Крем\nарт. 5",)
+
+
+def test_parser_cache():
+    parser = ProductParser(maxsize=1)
+    subject = "<p>1. Крем 50 мл</p>"
+    assert parser.parse(subject) is parser.parse(subject)
+    assert (parser.hits, parser.misses) == (1, 1)
+
+    parser.parse("<p>2. Лосьон 100 мл</p>")
+    parser.parse(subject)
+    assert (parser.hits, parser.misses) == (1, 3)
@@ -0,0 +1,52 @@
+import io
+from zipfile import ZipFile
+
+import pytest
+from openpyxl import load_workbook
+
+from src.export.xlsx_writer import ERROR_HEADERS, REPORT_HEADERS, SUMMARY_HEADERS, StreamingXlsxWriter
+
+ROWS = [
+    ("Бренд", "Линейка 1", "1. Крем 50 мл", "1 мая", "Иванов", "Петров", "Согласовано", "", "Ждём образцы"),
+    ("Бренд", "Линейка 1", "2. Лосьон 100 мл\nарт. 2", "1 мая", "Иванов", "Петров", "", "В работе", ""),
+]
+
+
+# in_memory=True собирает архив своим ExcelWriter поверх внутренних методов openpyxl:
+# книга должна открываться так же, как сохранённая штатным путём
+@pytest.mark.parametrize("in_memory", [False, True])
+def test_workbook_round_trip(in_memory):
+    writer = StreamingXlsxWriter({column: 20 for column in range(1, 11)}, title="Линейка: 1/2", in_memory=in_memory)
+    for values in ROWS:
+        writer.write_row(values)
+    writer.write_summary([("Бренд", "Иванов", 1, 2)])
+    writer.write_errors([("Бренд", "Линейка 2", "KeyError: 'subject'")])
+    target = io.BytesIO()
+    writer.save(target)
+
+    # Excel, в отличие от openpyxl, не открывает книгу, если листы не объявлены в [Content_Types].xml
+    content_types = ZipFile(target).read("[Content_Types].xml").decode()
+    for sheet in range(1, 4):
+        assert f'PartName="/xl/worksheets/sheet{sheet}.xml"' in content_types
+
+    workbook = load_workbook(io.BytesIO(target.getvalue()))
+    assert workbook.sheetnames == ["Линейка  1 2", "Сводка", "Ошибки"]
+    tasks, summary, errors = workbook.worksheets
+    assert [list(row) for row in tasks.iter_rows(values_only=True)] == [
+        REPORT_HEADERS,
+        [1, *(value or None for value in ROWS[0])],
+        [2, *(value or None for value in ROWS[1])],
+    ]
+    assert tasks.column_dimensions["D"].width == 20
+    assert tasks["A1"].style == "report_header"
+    assert tasks["D3"].alignment.wrap_text
+    assert [list(row) for row in summary.iter_rows(values_only=True)] == [SUMMARY_HEADERS, [1, "Бренд", "Иванов", 1, 2]]
+    assert [list(row) for row in errors.iter_rows(values_only=True)] == [
+        ERROR_HEADERS, [1, "Бренд", "Линейка 2", "KeyError: 'subject'"]]
+
+
+@pytest.mark.parametrize("in_memory", [False, True])
+def test_empty_workbook(in_memory):
+    target = io.BytesIO()
+    StreamingXlsxWriter(in_memory=in_memory).save(target)
+    assert len(load_workbook(io.BytesIO(target.getvalue())).worksheets) == 1